@@ -35,8 +35,8 @@ along with this program.  If not, see https://www.gnu.org/licenses/
 
 import os
 import numpy as np
-from netCDF4 import MFDataset, num2date
-import nc_func
+from netCDF4 import Dataset, MFDataset
+import nc_func_py3 as nc_func
 import watyrcalcs
 
 session_dir = r'Path\To\ensemble_ave\netCDFs'
@@ -51,9 +51,6 @@ lstRCP = ['historical', 'rcp85']
 clipExtent = [-104.06, 33.01, -80.5, 49.39]
 #slice index values for the clip extent - NOTE max values = index + 1
 clipIndex = [2516, 1074, 5343, 3040]
-pixelWidth = 0.00833333333
-pixelHeight = -0.00833333333
-arglist = [(clipExtent[0], clipExtent[3]), pixelWidth, pixelHeight]
 #%%#
 #Compile the individual netCDFs for each time period,
 # clip to area, and convert to usuable units (not in that order).
@@ -68,13 +65,13 @@ for var in lstVar:
         meta = 'Minimum Monthly Temperature in C, derived from ensemble average 800m ' \
         'Downscaled NEX CMIP5 Climate Projections for the Continental US'
     for rcp in lstRCP:
-        print var, rcp
+        print(var, rcp)
         outnc = '_'.join([var, 'NEXDCP', 'ens_avg', rcp])
         outnc = os.path.join(outdir, outnc + '.nc')
         if os.path.isfile(outnc):
             msg = 'The output ' + outnc + ' already exists.' + \
             '\nMoving on.\n'
-            print msg
+            print(msg)
         else:
             #Compile the individual nc files
             strSearch = var + '_ens-avg_amon_' + rcp + '*nc'
@@ -107,11 +104,14 @@ txnc = os.path.join(outdir, 'tasmax_NEXDCP_ens_avg_*.nc')
 tnnc = os.path.join(outdir, 'tasmin_NEXDCP_ens_avg_*.nc')
 hYrs = range(1971, 1999, 1)
 fYrs = range(2037, 2065, 1)
+#Read the compiled cubes a block at a time rather than all at once
+memLimit = 2 * 1024**3 #bytes
+#Geotiffs are written in the background while the next variable is computed
+writer = nc_func.RasterWriter(workers=2, max_bytes=memLimit)
 
 pptDS = MFDataset(pptnc)
 tVar = pptDS.variables['time']
 pVar = pptDS.variables['pr']
-pData = pVar[:]
 tData = tVar[:]
 tUnits = tVar.units
 tCalen = tVar.calendar
@@ -119,85 +119,63 @@ vLon = pptDS.variables['longitude']
 lnData = vLon[:]
 vLat = pptDS.variables['latitude']
 ltData = vLat[:]
-dateRng = num2date(tData, tUnits, tCalen)
-mydates = tData.tolist()
-mwargs = {'units': tUnits, 'calen': tCalen}
-pptDS.close()
+#Origin and pixel size of the output geotiffs, from the nc coordinates. The
+#grids stay south-up as stored (latitude increasing), write_raster takes
+#care of writing them north-up.
+arglist = nc_func.raster_args(lnData, ltData)
 #%%#
-for s in range(0, 5):
-    print 'Precipitation For season ' + str(s)
-    hmask = watyrcalcs.watyrmask(dateRng, mydates, hYrs, s, **mwargs)
-    fmask = watyrcalcs.watyrmask(dateRng, mydates, fYrs, s, **mwargs)
-    #Precipitation - historic & future means, and percent change
+#All seasons (annual, four seasons, and the two-season split) for both time
+#periods come out of one pass over the data.
+print('Precipitation, all seasons')
+pprods = watyrcalcs.season_products(pVar, tData, hYrs, fYrs, 'sum', 'pct',
+                                    tUnits, tCalen, mem_limit=memLimit)
+pptDS.close()
+#Precipitation - historic & future means, and percent change, for every
+#season as the bands of one compressed, tiled geotiff
+bands = []
+bandnames = []
+for s, (phist_mn, pfut_mn, pctchg) in pprods.items():
     prefix = watyrcalcs.clean_name('midwest', s, 'pr')
-    ftif = os.path.join(outdir, prefix + '_2050.tif')
-    htif = os.path.join(outdir, prefix + '_1985.tif')
-    chgtif = os.path.join(outdir, prefix + '_pctchange.tif')
-    pharray = nc_func.calc_it(pData, hmask, 'sum')
-    pfarray = nc_func.calc_it(pData, fmask, 'sum')
-    phist_mn = np.mean(pharray, axis=0)
-    phist_x = np.where(phist_mn == 0, 0.01, phist_mn) #avoid divide by zero
-    pfut_mn = np.mean(pfarray, axis=0)
-    pctchg = np.multiply(np.divide(np.subtract(pfut_mn, phist_mn), phist_x), 100)
-    phflip = nc_func.reverse(phist_mn)
-    pfflip = nc_func.reverse(pfut_mn)
-    chgflip = nc_func.reverse(pctchg)
-    #Save as geotiffs
-    nc_func.array2raster(htif, phflip, *arglist)
-    nc_func.array2raster(ftif, pfflip, *arglist)
-    nc_func.array2raster(chgtif, chgflip, *arglist)
-    #This is a lot to hold in memory, deleting as I go
-    del phist_x
+    bands += [phist_mn, pfut_mn, pctchg]
+    bandnames += [prefix + '_1985', prefix + '_2050', prefix + '_pctchange']
+ptif = os.path.join(outdir, 'midwest_pr_seasons.tif')
+writer.submit(nc_func.write_raster, ptif, bands, *arglist, bandnames=bandnames)
 
-del pData
 #%%#
 txDS = MFDataset(txnc)
 tnDS = MFDataset(tnnc)
 txVar = txDS.variables['tasmax']
 tnVar = tnDS.variables['tasmin']
-cols = txVar.shape[2]
-rows = txVar.shape[1]
-depth = txVar.shape[0]
-txData = txVar[:]
+#Get the mean temperature a block at a time so as not to run out of memory,
+#writing it straight to a new netCDF
+tmeannc = os.path.join(outdir, 'tmean_NEXDCP_ens_avg.nc')
+if not os.path.isfile(tmeannc):
+    kwargs = {'varname': 'tmean', 'units': tUnits, 'calendar': tCalen,
+              'metadatastr': 'Mean Monthly Temperature in C, the average of ' \
+              'tasmax and tasmin derived from ensemble average 800m ' \
+              'Downscaled NEX CMIP5 Climate Projections for the Continental US'}
+    nc_func.derive_nc(nc_func.block_mean, [txVar, tnVar], tData, ltData, lnData,
+                      tmeannc, mem_limit=memLimit, **kwargs)
 txDS.close()
-tnData = tnVar[:]
 tnDS.close()
-mxChunk = np.split(txData, depth)
-mnChunk = np.split(tnData, depth)
-del txData
-del tnData
-#Get the mean temperature a chunk at a time so as not to run out of memory
-for i in range(depth):
-    rawChunk = np.concatenate((mxChunk[i], mnChunk[i]), axis=0)
-    aveChunk = np.mean(rawChunk, axis=0, keepdims=True)
-    addChunk = np.reshape(aveChunk, (-1, rows, cols))
-    if i == 0:
-        tmean = np.array(addChunk)
-    else:
-        tmean = np.concatenate((tmean, addChunk), axis=0)
-del mxChunk
-del mnChunk
 
-for s in range(0, 5):
-    print 'Temperature For season ' + str(s)
-    #Mean Temperature - historic & future means, and absolute change (delta)
+tmeanDS = Dataset(tmeannc)
+tmean = tmeanDS.variables['tmean']
+
+print('Temperature, all seasons')
+tprods = watyrcalcs.season_products(tmean, tData, hYrs, fYrs, 'mean', 'delta',
+                                    tUnits, tCalen, mem_limit=memLimit)
+#Mean Temperature - historic & future means, and absolute change (delta)
+bands = []
+bandnames = []
+for s, (thist_mn, tfut_mn, tdelta) in tprods.items():
     prefix = watyrcalcs.clean_name('midwest', s, 'tmean')
-    ftif = os.path.join(outdir, prefix + '_2050.tif')
-    htif = os.path.join(outdir, prefix + '_1985.tif')
-    chgtif = os.path.join(outdir, prefix + '_delta.tif')
-    hmask = watyrcalcs.watyrmask(dateRng, mydates, hYrs, s, **mwargs)
-    fmask = watyrcalcs.watyrmask(dateRng, mydates, fYrs, s, **mwargs)
-    tharray = nc_func.calc_it(tmean, hmask, 'mean')
-    tfarray = nc_func.calc_it(tmean, fmask, 'mean')
-    thist_mn = np.mean(tharray, axis=0)
-    tfut_mn = np.mean(tfarray, axis=0)
-    tdelta = np.subtract(tfut_mn, thist_mn)
-    thflip = nc_func.reverse(thist_mn)
-    tfflip = nc_func.reverse(tfut_mn)
-    deltflip = nc_func.reverse(tdelta)
-    #Save as geotiffs
-    nc_func.array2raster(htif, thflip, *arglist)
-    nc_func.array2raster(ftif, tfflip, *arglist)
-    nc_func.array2raster(chgtif, deltflip, *arglist)
+    bands += [thist_mn, tfut_mn, tdelta]
+    bandnames += [prefix + '_1985', prefix + '_2050', prefix + '_delta']
+ttif = os.path.join(outdir, 'midwest_tmean_seasons.tif')
+writer.submit(nc_func.write_raster, ttif, bands, *arglist, bandnames=bandnames)
+tmeanDS.close()
+#Wait for the geotiffs; raises if any of them failed
+writer.close()
 
-print 'Completed'
+print('Completed')
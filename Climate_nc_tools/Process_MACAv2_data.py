@@ -59,8 +59,8 @@ along with this program.  If not, see https://www.gnu.org/licenses/
 """
 #%%#
 import os
+import sys
 import numpy as np
-from netCDF4 import Dataset
 import nc_func_py3 as nc_func
 
 session_dir = r"H:\Climate\Future"
@@ -70,95 +70,78 @@ scenarios = ["IPSL-CM5A-LR_r1i1p1_rcp45", "MIROC5_r1i1p1_rcp85"]
 var_dict = {"pr":"precipitation", "tasmax":"air_temperature",
             "tasmin":"air_temperature"}
 yrsets = ["2076_2080", "2081_2085", "2086_2090", "2091_2095", "2096_2099"]
-cell = 0.041666667
-inbbox = [-124.7666666, 49.4, -67.0583333, 25.06666667] #full dataset
-#minX, maxY, maxX, minY for your study area:
-outbbox = [-112.558333169, 49.024999997, -96.058333532, 29.483333372]
-clip_idx = nc_func.clipindex_fromXY((inbbox[0], inbbox[1]),
-                                    (inbbox[2], inbbox[3]),
-                                    (outbbox[0], outbbox[1]),
-                                    (outbbox[2], outbbox[3]), cell)
+#minX, maxY, maxX, minY for each study area. All areas are clipped in one
+#pass over each source file, into a sub-folder of outdir per area.
+regions = {"NGP": [-112.558333169, 49.024999997, -96.058333532, 29.483333372]}
 
-filepfx = var_dict.keys()
-daycnt = 1827 #each file = 5yr chunk with leap years, so 1,827 days.
+filepfx = list(var_dict.keys())
+workers = 6 #number of outputs to compile at once
+memcap = 8 * 1024**3 #bytes of memory each worker may use
+#Storage options for the compiled netCDFs (see nc_func.new_nc). Add
+#"least_significant_digit" or "pack_range" for much smaller, lossy, files.
+ncopts = {"chunks": "map", "zlib": True, "complevel": 4}
 
-def extractvars(nc_name, clip, var):
-    """Return a subsetted numpy masked array from the nc file """
-    dset = Dataset(nc_name)
-    dvar = dset.variables[var]
-    ary = dvar[:, clip[3]:clip[1], clip[0]:clip[2]]
-    if var == "air_temperature":
-        ary = np.subtract(ary, 273.15) #Convert K to C
-    dset.close()
-    return ary
+def k_to_c(ary):
+    """Convert K to C"""
+    return np.subtract(ary, 273.15)
 
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-#%%#
-for scen in scenarios:
-    for pfx in filepfx:
-        print(scen, pfx)
-        outnc = "_".join([pfx, scen, "MACAv2metdata", "2076_2099.nc"])
-        outnc = os.path.join(outdir, outnc)
-        if os.path.isfile(outnc):
-            msg = 'The output ' + outnc + ' already exists.' + \
-            '\nMoving on.\n'
-            print(msg)
+def compile_scenario(scen, pfx):
+    """Compile the clipped 2076-2099 netCDFs of every region for one scenario
+    and variable. Each call writes its own output files, so calls can run in
+    parallel. If a previous run was interrupted, each output picks up after
+    the last 5-year file that was completely appended to it.
+    """
+    print(scen, pfx)
+    outnc = "_".join([pfx, scen, "MACAv2metdata", "2076_2099.nc"])
+    outputs = dict((os.path.join(outdir, region, outnc), bbox)
+                   for region, bbox in regions.items())
+    #NOTE NETCDF4 format can't use MFDataset for the compilation.
+    #Here's a work-around: append each file in turn to a new nc with
+    #dimensions in the expected order (T, Y, X).
+    fileset = "_".join(["macav2metdata", pfx, scen, "Z", "CONUS_daily.nc"])
+    sources = [os.path.join(session_dir, fileset.replace("Z", yrset)) for yrset in yrsets]
+    if pfx == "pr":
+        meta = "Total daily precipitation in mm."
+        convert = None
+    elif pfx == "tasmin":
+        meta = "Mean daily minimum air temperature in degrees C."
+        convert = k_to_c
+    elif pfx == "tasmax":
+        meta = "Mean daily maximum air temperature in degrees C."
+        convert = k_to_c
+    kwargs = {"metadatastr": meta}
+    kwargs.update(ncopts)
+    #Clip to the areas of interest - note in this case Y increases North, and
+    #X is based on 0-360 instead of -180 to +180.
+    added = nc_func.compile_regions(sources, outputs, var_dict[pfx],
+                                    convert=convert, xoffset=-360, **kwargs)
+    for outname, srcs in added.items():
+        if not srcs:
+            print('The output ' + outname + ' is already complete.\nMoving on.\n')
         else:
-            #Compile the individual nc files
-            fileset = "_".join(["macav2metdata", pfx, scen, "Z", "CONUS_daily.nc"])
-            #NOTE NETCDF4 format can't use MFDataset for the compilation.
-            #Here's a work-around:
+            print("Finished", outname)
 
-            #Create a new nc with dimensions in the expected order (T, Y, X).
-            initnc = os.path.join(session_dir, fileset.replace("Z", yrsets[0]))
-            ncd = Dataset(initnc)
-            vVar = ncd.variables[var_dict[pfx]]
-            #Clip to area of interest - note in this case Y increases North, and
-            #X is based on 0-360 instead of -180 to +180.
-            clipData = vVar[:, clip_idx[3]:clip_idx[1], clip_idx[0]:clip_idx[2]]
-            vLon = ncd.variables["lon"]
-            lnSlice = vLon[clip_idx[0]:clip_idx[2]]
-            lnSlice = np.subtract(lnSlice, 360) #Correct for 0-360 notation
-            vLat = ncd.variables["lat"]
-            ltSlice = vLat[clip_idx[3]:clip_idx[1]]
-            vTime = ncd.variables["time"]
-            tData = vTime[:] #Get the full time period for now
-            # FIXME: now getting a deprecation warning below
-            tUnits = vTime.units
-            tCalen = vTime.calendar
-            ##
-            ncd.close()
-            if pfx == "pr":
-                meta = "Total daily precipitation in mm."
-            elif pfx == "tasmin":
-                meta = "Mean daily minimum air temperature in degrees C."
-                clipData = np.subtract(clipData, 273.15) #Convert K to C
-            elif pfx == "tasmax":
-                meta = "Mean daily maximum air temperature in degrees C."
-                clipData = np.subtract(clipData, 273.15) #Convert K to C
-            kwargs = {"varname": var_dict[pfx], "units": tUnits, "calendar": tCalen,
-                      "metadatastr": meta}
-            #Save as new netCDF with an unlimited time dimension
-            nc_func.new_nc(clipData, tData, ltSlice, lnSlice, outnc, **kwargs)
-            #Now we have to iterate over all the other nc files and append the
-            #data to outnc
-            masterd = Dataset(outnc, "a") #previous function closed it so have to reopen
-            for i in range(1, 5):
-                yrset = yrsets[i]
-                addnc = os.path.join(session_dir, fileset.replace("Z", yrset))
-                addSlice = extractvars(addnc, clip_idx, var_dict[pfx])
-                daycnt = addSlice.shape[0]
-                mtime = masterd.variables["time"]
-                lastime = mtime[-1]
-                lentime = len(mtime)
-                startidx = lentime - daycnt
-                newtimes = np.ma.add(mtime[startidx:], + daycnt)
-                data = masterd.variables[var_dict[pfx]]
-                data[lentime:lentime + daycnt, :, :] = addSlice
-                mtime[lentime:lentime + daycnt] = newtimes
-                masterd.sync()
+def open_scenario(scen, pfx, region):
+    """Open the 2076-2099 series for one scenario, variable and region
+    straight from the 5-year source files, clipped and converted to C on the
+    fly, without compiling a copy (see nc_func.AggVariable). Slice it like a
+    netCDF variable and close() it when done.
+    """
+    fileset = "_".join(["macav2metdata", pfx, scen, "Z", "CONUS_daily.nc"])
+    sources = [os.path.join(session_dir, fileset.replace("Z", yrset)) for yrset in yrsets]
+    convert = None if pfx == "pr" else k_to_c
+    rows, cols = nc_func.nc_clip_plan(sources[0], [regions[region]])[0]
+    return nc_func.AggVariable(sources, var_dict[pfx],
+                               rows=rows, cols=cols,
+                               convert=convert, xoffset=-360)
 
-            masterd.close()
-            print("Finished", outnc)
+if __name__ == "__main__":
+    for region in regions:
+        if not os.path.exists(os.path.join(outdir, region)):
+            os.makedirs(os.path.join(outdir, region))
+    #Each scenario/variable output is independent, so compile them in parallel.
+    failed = nc_func.run_jobs(compile_scenario,
+                              [(scen, pfx) for scen in scenarios for pfx in filepfx],
+                              workers=workers, mem_cap=memcap)
+    sys.exit(1 if failed else 0)
 #%%#
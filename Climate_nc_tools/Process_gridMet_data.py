@@ -56,8 +56,8 @@ along with this program.  If not, see https://www.gnu.org/licenses/
 """
 
 import os
+import sys
 import numpy as np
-from netCDF4 import Dataset
 import nc_func_py3 as nc_func
 
 session_dir = r"E:\Climate\metdata"
@@ -66,89 +66,81 @@ outdir = os.path.join(session_dir, outFolder)
 var_dict = {"pr":"precipitation_amount", "tmmn":"air_temperature",
             "tmmx":"air_temperature", "pet":"potential_evapotranspiration"}
 hYrs = range(1994, 2015, 1)
-cell = 0.041666667
-inbbox = [-124.7666666, 49.4, -67.0583333, 25.06666667] #full dataset
-#minX, maxY, maxX, minY for your study area:
-outbbox = [-112.558333169, 49.024999997, -96.058333532, 29.483333372]
-clip_idx = nc_func.clipindex_fromXY((inbbox[0], inbbox[1]),
-                                    (inbbox[2], inbbox[3]),
-                                    (outbbox[0], outbbox[1]),
-                                    (outbbox[2], outbbox[3]), cell)
+#minX, maxY, maxX, minY for each study area. All areas are clipped in one
+#pass over each source file, into a sub-folder of outdir per area.
+regions = {"NGP": [-112.558333169, 49.024999997, -96.058333532, 29.483333372]}
 
-filepfx = var_dict.keys()
+filepfx = list(var_dict.keys())
+workers = 4 #number of outputs to compile at once
+memcap = 8 * 1024**3 #bytes of memory each worker may use
+#Storage options for the compiled netCDFs (see nc_func.new_nc). Add
+#"least_significant_digit" or "pack_range" for much smaller, lossy, files.
+ncopts = {"chunks": "map", "zlib": True, "complevel": 4}
 
-def extractvars(nc_name, clip, var):
-    """Return a subsetted numpy masked array from the nc file """
-    dset = Dataset(nc_name)
-    dvar = dset.variables[var]
-    ary = dvar[:, clip[3]:clip[1], clip[0]:clip[2]]
-    if var == "air_temperature":
-        ary = np.subtract(ary, 273.15) #Convert K to C
-    dset.close()
-    return ary
+def k_to_c(ary):
+    """Convert K to C"""
+    return np.subtract(ary, 273.15)
 
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-
-#Compile the individual netCDFs
-for pfx in filepfx:
+def compile_var(pfx):
+    """Compile the clipped gridMET netCDFs of every region for one variable.
+    Each call writes its own output files, so calls can run in parallel. If a
+    previous run was interrupted, each output picks up after the last yearly
+    file that was completely appended to it.
+    """
     print("Starting on", pfx)
     fileset = pfx + "_Z.nc"
     outnc = "_".join([pfx, "gridmet", str(hYrs[0]), str(hYrs[-1])]) + ".nc"
-    outnc = os.path.join(outdir, outnc)
+    outputs = dict((os.path.join(outdir, region, outnc), bbox)
+                   for region, bbox in regions.items())
     #NOTE that these nc files are unusually structured for NETCDF3_CLASSIC format,
     #so can't use MFDataset for the compilation.
-    #Here's a work-around:
-
-    #Create a new nc with dimensions in the expected order (T, Y, X). Starting with
-    #the year *before* our desired date range so that water-years can be calculated.
-    initnc = os.path.join(session_dir, fileset.replace("Z", str(hYrs[0] - 1)))
-    ncd = Dataset(initnc)
-    vVar = ncd.variables[var_dict[pfx]]
-    #Clip to area of interest - note in this case Y increases North, so slice
-    #values are reversed from other climate data such as NEX and Daymet.
-    clipData = vVar[:, clip_idx[3]:clip_idx[1], clip_idx[0]:clip_idx[2]]
-    vLon = ncd.variables["lon"]
-    lnSlice = vLon[clip_idx[0]:clip_idx[2]]
-    vLat = ncd.variables["lat"]
-    ltSlice = vLat[clip_idx[3]:clip_idx[1]]
-    vTime = ncd.variables["day"]
-    tData = vTime[:] #Want the full year
-    tUnits = vTime.units
-    tCalen = vTime.calendar
-    ncd.close()
+    #Here's a work-around: append each yearly file in turn to a new nc with
+    #dimensions in the expected order (T, Y, X). Starting with the year *before*
+    #our desired date range so that water-years can be calculated.
+    sources = [os.path.join(session_dir, fileset.replace("Z", str(yr)))
+               for yr in range(hYrs[0] - 1, hYrs[-1] + 1)]
+    convert = None
     if pfx == "pr":
         meta = "Total daily precipitation in mm, from gridded surface meteorological data."
     elif pfx == "tmmn":
         meta = "Mean daily minimum air temperature in degrees Celcius, from gridded surface meteorological data."
-        clipData = np.subtract(clipData, 273.15) #Convert K to C
+        convert = k_to_c
     elif pfx == "tmmx":
         meta = "Mean daily maximum air temperature in degrees Celcius, from gridded surface meteorological data."
-        clipData = np.subtract(clipData, 273.15) #Convert K to C
+        convert = k_to_c
     else:
         meta = "Daily reference evapotranspiration (short grass) in mm, from gridded surface meteorological data."
-    kwargs = {"varname": var_dict[pfx], "units": tUnits, "calendar": tCalen,
-              "metadatastr": meta}
-    #Save as new netCDF with an unlimited time dimension
-    nc_func.new_nc(clipData, tData, ltSlice, lnSlice, outnc, **kwargs)
-
-    #Now we have to iterate over all the other nc files and append the data to outnc
-    masterd = Dataset(outnc, "a") #previous function closed it so have to reopen
-    for i in hYrs:
-        if i % 4 == 0:
-            daycnt = 366 #leap years
+    kwargs = {"metadatastr": meta}
+    kwargs.update(ncopts)
+    #Clip to the areas of interest, in one pass over each yearly file
+    added = nc_func.compile_regions(sources, outputs, var_dict[pfx],
+                                    convert=convert, src_time="day", **kwargs)
+    for outname, srcs in added.items():
+        if not srcs:
+            print('The output ' + outname + ' is already complete.')
         else:
-            daycnt = 365
-        addnc = os.path.join(session_dir, fileset.replace("Z", str(i)))
-        addSlice = extractvars(addnc, clip_idx, var_dict[pfx])
-        mtime = masterd.variables["time"] #new_nc function changed the variable name
-        lastime = mtime[-1]
-        lentime = len(mtime)
-        startidx = lentime - daycnt
-        newtimes = np.ma.add(mtime[startidx:], + daycnt)
-        data = masterd.variables[var_dict[pfx]]
-        data[lentime:lentime + daycnt, :, :] = addSlice
-        mtime[lentime:lentime + daycnt] = newtimes
-        masterd.sync()
-    masterd.close()
-    print("Finished", outnc)
+            print("Finished", outname)
+
+def open_var(pfx, region):
+    """Open the series for one variable and region straight from the yearly
+    source files, clipped and converted to C on the fly, without compiling a
+    copy (see nc_func.AggVariable). Slice it like a netCDF variable and
+    close() it when done.
+    """
+    fileset = pfx + "_Z.nc"
+    sources = [os.path.join(session_dir, fileset.replace("Z", str(yr)))
+               for yr in range(hYrs[0] - 1, hYrs[-1] + 1)]
+    convert = k_to_c if pfx in ("tmmn", "tmmx") else None
+    rows, cols = nc_func.nc_clip_plan(sources[0], [regions[region]])[0]
+    return nc_func.AggVariable(sources, var_dict[pfx],
+                               rows=rows, cols=cols,
+                               convert=convert, src_time="day")
+
+if __name__ == "__main__":
+    for region in regions:
+        if not os.path.exists(os.path.join(outdir, region)):
+            os.makedirs(os.path.join(outdir, region))
+    #Compile the individual netCDFs, one variable per worker
+    failed = nc_func.run_jobs(compile_var, [(pfx,) for pfx in filepfx],
+                              workers=workers, mem_cap=memcap)
+    sys.exit(1 if failed else 0)
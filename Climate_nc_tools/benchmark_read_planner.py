@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the chunk-aligned netCDF read planner in nc_func_py3
+(read_clip and iter_blocks) against plain slicing, on a synthetic file with
+the same chunking and compression as the MACAv2 daily CONUS files
+(chunks [123,51,162], shuffle, deflate level 5).
+
+Run from the command line:
+    python benchmark_read_planner.py [scratch_dir]
+
+The synthetic file is one year of random daily values on the 585 x 1386
+MACA grid (about 1.2 GB uncompressed), so it takes a minute or two to build.
+
+Code licensed under the GNU General Public License version 3.
+This script is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see https://www.gnu.org/licenses/
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+import nc_func_py3 as nc_func
+
+NTIME, NLAT, NLON = 365, 585, 1386
+CHUNKS = (123, 51, 162)
+#A study-area clip that does not line up with the chunk grid
+CLIP_ROWS = slice(10, 480)
+CLIP_COLS = slice(300, 700)
+BLOCK_DAYS = 30 #unaligned streaming block, e.g. one month at a time
+
+def make_file(ncname):
+    """Write the synthetic test file, one chunk-depth of days at a time"""
+    dset = Dataset(ncname, 'w', format='NETCDF4')
+    dset.createDimension('time', None)
+    dset.createDimension('lat', NLAT)
+    dset.createDimension('lon', NLON)
+    dvar = dset.createVariable('precipitation', 'f4', ('time', 'lat', 'lon'),
+                               chunksizes=CHUNKS, zlib=True, shuffle=True,
+                               complevel=5, fill_value=-9999)
+    rng = np.random.default_rng(42)
+    for t0 in range(0, NTIME, CHUNKS[0]):
+        t1 = min(t0 + CHUNKS[0], NTIME)
+        dvar[t0:t1] = rng.gamma(0.5, 4.0, (t1 - t0, NLAT, NLON)).astype('f4')
+    dset.close()
+
+def timed(ncname, func):
+    """Time func(variable) on a freshly opened file, so the chunk cache
+    starts empty.
+    """
+    dset = Dataset(ncname)
+    dvar = dset.variables['precipitation']
+    start = time.time()
+    result = func(dvar)
+    elapsed = time.time() - start
+    dset.close()
+    return elapsed, result
+
+def slab_read(dvar):
+    """Plain slicing: one slice for the whole clip"""
+    return dvar[:, CLIP_ROWS, CLIP_COLS]
+
+def blocked_read(dvar):
+    """Unaligned time blocks with the default chunk cache"""
+    out = np.ma.empty((NTIME, CLIP_ROWS.stop - CLIP_ROWS.start,
+                       CLIP_COLS.stop - CLIP_COLS.start), dtype='f4')
+    for t0 in range(0, NTIME, BLOCK_DAYS):
+        out[t0:t0 + BLOCK_DAYS] = dvar[t0:t0 + BLOCK_DAYS, CLIP_ROWS, CLIP_COLS]
+    return out
+
+def planned_read(dvar):
+    """Chunk-aligned read planner"""
+    return nc_func.read_clip(dvar, rows=CLIP_ROWS, cols=CLIP_COLS)
+
+def streamed_sum(dvar):
+    """Whole-grid streaming sum with chunk-aligned blocks of ~BLOCK_DAYS"""
+    budget = BLOCK_DAYS * NLAT * NLON * 5
+    total = np.zeros((NLAT, NLON))
+    for _, rows, block in nc_func.iter_blocks(dvar, budget):
+        total[rows] += block.sum(axis=0)
+    return total
+
+def unaligned_sum(dvar):
+    """Whole-grid streaming sum with unaligned BLOCK_DAYS blocks"""
+    total = np.zeros((NLAT, NLON))
+    for t0 in range(0, NTIME, BLOCK_DAYS):
+        total += dvar[t0:t0 + BLOCK_DAYS].sum(axis=0)
+    return total
+
+if __name__ == "__main__":
+    scratch = sys.argv[1] if len(sys.argv) > 1 else tempfile.gettempdir()
+    testnc = os.path.join(scratch, 'read_planner_benchmark.nc')
+    if not os.path.isfile(testnc):
+        print('Building', testnc)
+        make_file(testnc)
+    reference = None
+    for name, func in [('clip, one slab', slab_read),
+                       ('clip, unaligned 30-day blocks', blocked_read),
+                       ('clip, read_clip', planned_read)]:
+        secs, ary = timed(testnc, func)
+        if reference is None:
+            reference = ary
+        same = np.ma.allclose(ary, reference)
+        print('{:34s} {:7.2f} s  matches: {}'.format(name, secs, same))
+    reference = None
+    for name, func in [('full grid, unaligned 30-day blocks', unaligned_sum),
+                       ('full grid, iter_blocks', streamed_sum)]:
+        secs, ary = timed(testnc, func)
+        if reference is None:
+            reference = ary
+        same = np.allclose(ary, reference)
+        print('{:34s} {:7.2f} s  matches: {}'.format(name, secs, same))
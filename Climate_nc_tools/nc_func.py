@@ -38,10 +38,10 @@ def calc_it(data, masks, method):
     """
     if method == 'sum':
         return np.ma.array([np.ma.sum(np.ma.take(data, aMask, axis=0), axis=0,
-                                      dtype=np.float) for aMask in masks])
+                                      dtype=np.float64) for aMask in masks])
     elif method == 'mean':
         return np.ma.array([np.ma.mean(np.ma.take(data, aMask, axis=0), axis=0,
-                                       dtype=np.float) for aMask in masks])
+                                       dtype=np.float64) for aMask in masks])
 
 def reverse(array, axis=0):
     """Flip a 2D array derived from a netCDF upside down (y axis).
@@ -50,7 +50,7 @@ def reverse(array, axis=0):
     """
     idx = [slice(None)]*len(array.shape)
     idx[axis] = slice(None, None, -1)
-    return array[idx]
+    return array[tuple(idx)]
 
 def raster2array(ras_name, flip=True):
     """Convert a geoTIFF to a 2D numpy array.
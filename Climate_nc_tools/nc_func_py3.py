@@ -20,53 +20,578 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see https://www.gnu.org/licenses/
 """
+import os
+import json
 import time
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from osgeo import osr, gdal
-from netCDF4 import Dataset
+from netCDF4 import Dataset, num2date, date2num, default_fillvals
 
 gdal.UseExceptions()
 
+GROUP_STATS = ('sum', 'mean', 'min', 'max', 'count', 'std')
+MEM_LIMIT = 2 * 1024**3 #default bytes of data to read at once when streaming
+#Precision policy: data is stored, streamed and returned as FLOAT_DTYPE.
+#Only the running sums inside the reduction kernels use ACCUM_DTYPE.
+FLOAT_DTYPE = np.float32
+ACCUM_DTYPE = np.float64
+
+def to_nan(block, dtype=FLOAT_DTYPE):
+    """A plain float array with NaN wherever block is masked (or was already
+    NaN), for the NaN-aware numeric core. Does not copy a plain array that
+    already has the right type.
+    """
+    if np.ma.isMaskedArray(block):
+        out = np.asarray(np.ma.getdata(block), dtype=dtype)
+        mask = np.ma.getmask(block)
+        if mask is not np.ma.nomask and mask.any():
+            if out is np.ma.getdata(block):
+                out = out.copy()
+            out[mask] = np.nan
+        return out
+    return np.asarray(block, dtype=dtype)
+
+def read_nan(var, key=Ellipsis, dtype=FLOAT_DTYPE):
+    """Read var[key] from a netCDF variable as a plain float array, with its
+    _FillValue, missing_value (e.g. -9999, -32767) or default fill values
+    turned into NaN once, as it is read, instead of building a masked array.
+    Packed variables and other array-likes are read as usual and converted.
+    """
+    if not hasattr(var, 'set_auto_mask') or hasattr(var, 'scale_factor'):
+        return to_nan(var[key], dtype)
+    var.set_auto_mask(False)
+    try:
+        raw = var[key]
+    finally:
+        var.set_auto_mask(True)
+    missing = [getattr(var, att) for att in ('_FillValue', 'missing_value')
+               if hasattr(var, att)]
+    if not hasattr(var, '_FillValue'):
+        missing.append(default_fillvals[np.dtype(var.dtype).str[1:]])
+    invalid = None
+    for val in missing:
+        hit = raw == np.asarray(val, dtype=raw.dtype)
+        invalid = hit if invalid is None else invalid | hit
+    out = np.asarray(raw, dtype=dtype)
+    if invalid is not None and invalid.any():
+        out[invalid] = np.nan
+    return out
+
+def label_runs(labels):
+    """Find the runs of identical group labels along the time axis.
+    labels = integer array, one label per time step. Negative labels mark
+      time steps that do not belong to any group. A 2D array [scheme, time]
+      lets every time step belong to one group in each of several grouping
+      schemes (e.g. a year, a season and a half-year at once). Group numbers
+      are shared by all schemes, so each scheme needs its own set of labels.
+
+    output: three arrays (starts, stops, labels) describing each run, so
+      that data[starts[i]:stops[i]] is a view belonging to group labels[i]
+      (a row of labels, one per scheme, for 2D input).
+    """
+    labels = np.asarray(labels)
+    length = labels.shape[-1]
+    if length == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, labels.T
+    if labels.ndim == 1:
+        change = labels[1:] != labels[:-1]
+    else:
+        change = np.any(labels[:, 1:] != labels[:, :-1], axis=0)
+    edges = np.flatnonzero(change) + 1
+    starts = np.concatenate(([0], edges))
+    stops = np.concatenate((edges, [length]))
+    runlabels = labels[..., starts].T
+    keep = runlabels >= 0
+    if keep.ndim > 1:
+        keep = keep.any(axis=1)
+    return starts[keep], stops[keep], runlabels[keep]
+
+class GroupAccumulator(object):
+    """Running per-group statistics along the time axis of a [time, y, x] cube.
+
+    Data is fed in with update(), either all at once or one time block at a
+    time, together with an integer label for every time step. Each contiguous
+    run of identical labels is reduced as a view of the input, so no per-group
+    copy of the data is ever made; memory use is one output slice per group
+    for each statistic kept.
+
+    ngroups = integer; number of groups (labels 0 to ngroups - 1)
+    shape = tuple; shape of a single time slice, usually (y, x)
+    stats = iterable of statistic names taken from GROUP_STATS
+    dtype = float type of the results. Sums and moments are accumulated in
+      ACCUM_DTYPE whatever it is, one output slice per group, so no float64
+      copy of the data itself is ever made.
+    """
+    def __init__(self, ngroups, shape, stats=GROUP_STATS, dtype=FLOAT_DTYPE):
+        stats = set(stats)
+        bad = stats.difference(GROUP_STATS)
+        if bad:
+            raise ValueError('Unknown statistic(s): ' + ', '.join(sorted(bad)))
+        self.ngroups = ngroups
+        self.shape = tuple(shape)
+        self.stats = stats
+        self.dtype = np.dtype(dtype)
+        full = (ngroups,) + self.shape
+        self.count = np.zeros(full, dtype=np.int32)
+        self.total = None
+        self.mean = None
+        self.m2 = None
+        self.low = None
+        self.high = None
+        if stats.intersection(('sum', 'mean')):
+            self.total = np.zeros(full, dtype=ACCUM_DTYPE)
+        if 'std' in stats:
+            self.mean = np.zeros(full, dtype=ACCUM_DTYPE)
+            self.m2 = np.zeros(full, dtype=ACCUM_DTYPE)
+        #Minima and maxima are exact in the result type
+        if 'min' in stats:
+            self.low = np.full(full, np.inf, dtype=self.dtype)
+        if 'max' in stats:
+            self.high = np.full(full, -np.inf, dtype=self.dtype)
+
+    def update(self, block, labels, rows=None):
+        """Add a block of time steps to the running statistics.
+        block = ndarray or masked array; [time, y, x]. NaN values in a
+          float ndarray (see to_nan) are skipped like masked ones.
+        labels = integer array with one group label per time step of block,
+          or a 2D [scheme, time] array (see label_runs). Each run is reduced
+          once and then merged into the group it has in every scheme.
+        rows = slice (optional); the rows (y) of the full grid that block
+          covers, when the data is streamed in bands of rows.
+        """
+        if rows is None:
+            rows = slice(None)
+        labels = np.asarray(labels)
+        if block.shape[0] != labels.shape[-1]:
+            raise ValueError('Need one label per time step: got ' +
+                             str(labels.shape[-1]) + ' labels for ' +
+                             str(block.shape[0]) + ' time steps')
+        if np.ma.isMaskedArray(block):
+            values = np.ma.getdata(block)
+            mask = np.ma.getmask(block)
+        else:
+            values = np.asarray(block)
+            mask = np.ma.nomask
+        isfloat = values.dtype.kind == 'f'
+        for start, stop, grps in zip(*label_runs(labels)):
+            grps = np.atleast_1d(grps)
+            grps = grps[grps >= 0]
+            run = values[start:stop]
+            if mask is np.ma.nomask:
+                valid = True
+                cnt = stop - start
+                if isfloat:
+                    nans = np.isnan(run)
+                    if nans.any():
+                        valid = ~nans
+                        cnt = valid.sum(axis=0)
+            else:
+                valid = ~mask[start:stop]
+                cnt = valid.sum(axis=0)
+            if self.total is not None or self.m2 is not None:
+                runsum = np.sum(run, axis=0, dtype=ACCUM_DTYPE, where=valid)
+            #Integer runs go to the result type, which can hold the +-inf start
+            extreme = run if isfloat else run.astype(self.dtype)
+            if self.low is not None:
+                runlow = np.min(extreme, axis=0, initial=np.inf, where=valid)
+            if self.high is not None:
+                runhigh = np.max(extreme, axis=0, initial=-np.inf, where=valid)
+            if self.m2 is not None:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    runmean = runsum / cnt
+                    #Deviations in the result type, squares summed in ACCUM_DTYPE
+                    dev = np.subtract(run, runmean, dtype=self.dtype)
+                    np.square(dev, out=dev)
+                    runm2 = np.sum(dev, axis=0, dtype=ACCUM_DTYPE, where=valid)
+            for grp in grps:
+                tgt = (grp, rows)
+                if self.m2 is not None:
+                    self._merge_moments(tgt, cnt, runmean, runm2)
+                self.count[tgt] += cnt
+                if self.total is not None:
+                    self.total[tgt] += runsum
+                if self.low is not None:
+                    np.minimum(self.low[tgt], runlow, out=self.low[tgt])
+                if self.high is not None:
+                    np.maximum(self.high[tgt], runhigh, out=self.high[tgt])
+
+    def _merge_moments(self, tgt, cnt, runmean, runm2):
+        """Merge the mean and sum of squared deviations of one run into the
+        group's running values (Chan et al. pairwise update). Must be called
+        before the group's count is updated.
+        """
+        cnt = np.asarray(cnt, dtype=ACCUM_DTYPE)
+        prev = self.count[tgt]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = runmean - self.mean[tgt]
+            newcnt = prev + cnt
+            upd_mean = self.mean[tgt] + delta * cnt / newcnt
+            upd_m2 = self.m2[tgt] + runm2 + np.square(delta) * prev * cnt / newcnt
+        has = cnt > 0
+        self.mean[tgt] = np.where(has, upd_mean, self.mean[tgt])
+        self.m2[tgt] = np.where(has, upd_m2, self.m2[tgt])
+
+    def result(self, stat, nan=False):
+        """Return the requested statistic for every group as a masked array
+        [group, y, x] of the accumulator's dtype (counts are integers).
+        Pixels without any valid value in a group are masked, or NaN in a
+        plain array if nan is True.
+        """
+        if stat not in self.stats:
+            raise ValueError('Statistic ' + str(stat) + ' was not accumulated')
+        empty = self.count == 0
+        if stat == 'count':
+            return self.count.copy() if nan else np.ma.array(self.count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat == 'sum':
+                out = self.total
+            elif stat == 'mean':
+                out = self.total / self.count
+            elif stat == 'min':
+                out = self.low
+            elif stat == 'max':
+                out = self.high
+            else:
+                out = np.sqrt(self.m2 / self.count)
+        out = out.astype(self.dtype)
+        if nan:
+            return np.where(empty, np.nan, out)
+        return np.ma.array(out, mask=empty)
+
+def var_chunks(var):
+    """Storage chunk shape of a netCDF variable, or None if it is not chunked
+    (contiguous, netCDF3, MFDataset or plain array).
+    """
+    chunks = var.chunking() if hasattr(var, 'chunking') else None
+    if chunks is None or chunks == 'contiguous':
+        return None
+    return tuple(chunks)
+
+def fit_chunk_cache(var, nchunks, max_bytes=None):
+    """Make the chunk cache of a netCDF variable big enough to hold nchunks
+    chunks (but no more than max_bytes), so that chunks shared by consecutive
+    reads are not decompressed again. Never shrinks the cache.
+    """
+    chunks = var_chunks(var)
+    if chunks is None or not hasattr(var, 'set_var_chunk_cache'):
+        return
+    want = int(nchunks) * int(np.prod(chunks)) * np.dtype(var.dtype).itemsize
+    if max_bytes is not None:
+        want = min(want, int(max_bytes))
+    size, nelems, preempt = var.get_var_chunk_cache()
+    if want > size:
+        var.set_var_chunk_cache(size=want, nelems=max(nelems, 4 * int(nchunks) + 1),
+                                preemption=preempt)
+
+def block_plan(shape, itemsize, mem_limit=MEM_LIMIT, chunks=None):
+    """Work out how to cut a [time, y, x] cube into blocks that fit in a
+    memory budget. Whole time slices are used while they fit, otherwise the
+    grid is cut into bands of rows, one time step at a time.
+    shape = tuple; (time, y, x)
+    itemsize = integer; bytes per value (plus any mask)
+    mem_limit = integer; maximum bytes per block
+    chunks = tuple (optional); storage chunk shape. Block edges are then
+      rounded to chunk boundaries, trading rows for time steps if needed, so
+      each chunk is decompressed once.
+
+    output: tuple (time steps per block, rows per band)
+    """
+    ntime, nrows, ncols = shape
+    slice_bytes = max(1, nrows * ncols * itemsize)
+    if slice_bytes <= mem_limit:
+        tstep, ystep = max(1, min(ntime, mem_limit // slice_bytes)), nrows
+    else:
+        tstep, ystep = 1, max(1, mem_limit // max(1, ncols * itemsize))
+    if chunks is not None:
+        if tstep < min(chunks[0], ntime):
+            #Rather than re-reading each chunk for several thin time blocks,
+            #take a full chunk depth of time in narrower bands of rows
+            tstep = min(chunks[0], ntime)
+            ystep = max(1, min(nrows, mem_limit // max(1, tstep * ncols * itemsize)))
+        elif tstep < ntime:
+            tstep -= tstep % chunks[0]
+        if chunks[1] <= ystep < nrows:
+            ystep -= ystep % chunks[1]
+    return tstep, ystep
+
+def iter_slices(shape, itemsize, mem_limit=MEM_LIMIT, chunks=None):
+    """Slices that cut a [time, y, x] cube into blocks of at most mem_limit
+    bytes (see block_plan). Bands of rows are the outer loop and time the
+    inner one, so each band sees its time steps in order.
+
+    yields: tuple (time slice, row slice)
+    """
+    tstep, ystep = block_plan(shape, itemsize, mem_limit, chunks)
+    for y0 in range(0, shape[1], ystep):
+        rows = slice(y0, min(y0 + ystep, shape[1]))
+        for t0 in range(0, shape[0], tstep):
+            yield slice(t0, min(t0 + tstep, shape[0])), rows
+
+def iter_blocks(var, mem_limit=MEM_LIMIT, nan=False):
+    """Stream a [time, y, x] netCDF variable (Dataset or MFDataset) or array
+    in (time, y, x) hyperslabs that fit in mem_limit bytes. For chunked
+    variables the blocks follow chunk boundaries where possible and the
+    chunk cache is sized to the chunks one block touches.
+    nan = boolean; yield plain float32 blocks with NaN for missing values
+      (see read_nan) rather than masked arrays
+
+    yields: tuple (time slice, row slice, block)
+    """
+    shape = tuple(var.shape)
+    if nan:
+        itemsize = 4
+    else:
+        itemsize = np.dtype(var.dtype).itemsize + 1 #allow for the mask
+    chunks = var_chunks(var)
+    if chunks is not None:
+        tstep, ystep = block_plan(shape, itemsize, mem_limit, chunks)
+        fit_chunk_cache(var, (-(-ystep // chunks[1]) + 1) * (-(-shape[2] // chunks[2])),
+                        mem_limit)
+    for times, rows in iter_slices(shape, itemsize, mem_limit, chunks):
+        if nan:
+            yield times, rows, read_nan(var, (times, rows, slice(None)))
+        else:
+            yield times, rows, var[times, rows, :]
+
+def chunk_spans(start, stop, chunk):
+    """Split the index range [start, stop) at multiples of chunk, so each
+    piece lies within a single storage chunk along that dimension.
+
+    output: list of (start, stop) tuples
+    """
+    bounds = [start] + list(range((start // chunk + 1) * chunk, stop, chunk)) + [stop]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _read(var, key, nan):
+    """var[key], as a NaN-filled float32 array if nan is True"""
+    return read_nan(var, key) if nan else var[key]
+
+def read_clip(var, times=slice(None), rows=slice(None), cols=slice(None),
+              out=None, nan=False):
+    """Read a [time, y, x] hyperslab of a chunked netCDF variable in pieces
+    lined up with its storage chunks, so that every compressed chunk is
+    decompressed exactly once, even the ones straddling the clip edges.
+    The variable's chunk cache is sized to hold one row of chunks across
+    the x range, which is all the working set this read order needs.
+    var = netCDF4 Variable [time, y, x]
+    times, rows, cols = slices (step 1) of the time, y and x dimensions
+    out = ndarray or masked array (optional); preallocated result of the
+      clipped shape to fill in
+    nan = boolean; return a plain float32 array with NaN for missing values
+      (see read_nan) rather than a masked array
+
+    output: masked array (or out) holding var[times, rows, cols]
+    """
+    bounds = [sl.indices(n)[:2] for sl, n in zip((times, rows, cols), var.shape)]
+    shape = tuple(max(0, b - a) for a, b in bounds)
+    chunks = var_chunks(var)
+    if chunks is None:
+        if out is None:
+            return _read(var, (times, rows, cols), nan)
+        out[...] = _read(var, (times, rows, cols), nan)
+        return out
+    (t0, t1), (y0, y1), (x0, x1) = bounds
+    fit_chunk_cache(var, len(chunk_spans(x0, x1, chunks[2])) + 1)
+    if out is None and nan:
+        out = np.empty(shape, dtype=np.float32)
+    data = None
+    if out is None:
+        mask = np.zeros(shape, dtype=bool)
+    for ta, tb in chunk_spans(t0, t1, chunks[0]):
+        for ya, yb in chunk_spans(y0, y1, chunks[1]):
+            dst = (slice(ta - t0, tb - t0), slice(ya - y0, yb - y0), slice(None))
+            blk = _read(var, (slice(ta, tb), slice(ya, yb), slice(x0, x1)), nan)
+            if out is None:
+                #Typed like what the variable returns, not what it stores:
+                # packed int16 comes back as unpacked floats
+                if data is None:
+                    data = np.empty(shape, dtype=np.ma.getdata(blk).dtype)
+                data[dst] = np.ma.getdata(blk)
+                mask[dst] = np.ma.getmaskarray(blk)
+            else:
+                out[dst] = blk
+    if out is None:
+        return np.ma.array(data, mask=mask, copy=False)
+    return out
+
+def group_reduce(data, labels, method, ngroups=None, mem_limit=MEM_LIMIT,
+                 dtype=FLOAT_DTYPE):
+    """Reduce a [time, y, x] array for all groups in one pass along time.
+    data = ndarray, masked array or netCDF variable. A netCDF variable is
+      streamed through iter_blocks as NaN-filled float32 blocks, so only
+      mem_limit bytes of it are read into memory at once.
+    labels = 1D integer array; group label of each time step, negative labels
+      are skipped.
+    method = string or list of strings taken from GROUP_STATS
+    ngroups = integer (optional); defaults to the highest label + 1
+    mem_limit = integer; bytes of data to read at once (netCDF variables)
+    dtype = float type of the results (see GroupAccumulator)
+
+    output: masked array [group, y, x] for a single method, or a dictionary
+      of them keyed by method when a list of methods is given.
+    """
+    labels = np.asarray(labels)
+    if ngroups is None:
+        ngroups = int(labels.max()) + 1 if labels.size else 0
+    methods = [method] if isinstance(method, str) else list(method)
+    acc = GroupAccumulator(ngroups, data.shape[1:], methods, dtype)
+    if isinstance(data, np.ndarray):
+        acc.update(data, labels)
+    else:
+        for times, rows, block in iter_blocks(data, mem_limit, nan=True):
+            acc.update(block, labels[..., times], rows)
+    if isinstance(method, str):
+        return acc.result(method)
+    return dict((m, acc.result(m)) for m in methods)
+
+def masks_to_labels(masks, length):
+    """Convert a list of index masks (one per group) into a label array of
+    the given length. Returns None if the masks overlap, since a time step
+    can then belong to more than one group.
+    """
+    labels = np.full(length, -1, dtype=np.intp)
+    used = 0
+    for grp, aMask in enumerate(masks):
+        aMask = np.asarray(aMask, dtype=np.intp)
+        labels[aMask] = grp
+        used += aMask.size
+    if np.count_nonzero(labels >= 0) != used:
+        return None
+    return labels
+
 def calc_it(data, masks, method):
     """Run basic calculations on a masked array
-    Right now method can be either 'sum' or 'mean' along time axis
+    method can be any of GROUP_STATS ('sum', 'mean', 'min', 'max', 'count',
+    'std') along time axis
     data = ndarray
     masks = masks used to group data by years, seasons, month, etc.
-    method = string; 'sum' or 'mean'
+    method = string; 'sum' or 'mean' (or another of GROUP_STATS)
 
-    output: ndarray reduced by calculation to a time dimension of 1.
+    output: FLOAT_DTYPE masked array [group, y, x]; each group's time steps
+      reduced to one.
     """
-    if method == 'sum':
-        return np.ma.array([np.ma.sum(np.ma.take(data, aMask, axis=0), axis=0,
-                                      dtype=np.float) for aMask in masks])
-    elif method == 'mean':
-        return np.ma.array([np.ma.mean(np.ma.take(data, aMask, axis=0), axis=0,
-                                       dtype=np.float) for aMask in masks])
+    labels = masks_to_labels(masks, data.shape[0])
+    if labels is not None:
+        return group_reduce(data, labels, method, len(masks))
+    #Overlapping masks, so each one needs its own set of labels
+    out = []
+    for aMask in masks:
+        labels = masks_to_labels([np.unique(aMask)], data.shape[0])
+        out.append(group_reduce(data, labels, method, 1)[0])
+    return np.ma.array(out)
 
 def reverse(array, axis=0):
     """Flip a 2D array derived from a netCDF upside down (y axis).
     Necessary if the nc does not treat increasing y's as North,
     which happens more often than you might think.
+    Returns a reversed view, so no data is copied.
     """
     idx = [slice(None)]*len(array.shape)
     idx[axis] = slice(None, None, -1)
-    return array[idx]
+    return array[tuple(idx)]
 
-def raster2array(ras_name, flip=True):
-    """Convert a geoTIFF to a 2D numpy array.
-    Defaults to flipping axis 0 (y axis) on assumption that original
-    was flipped.
+def raster_args(xcoords, ycoords):
+    """The arglist for array2raster of a grid stored in a netCDF, worked out
+    from its cell-center coordinates. The pixel height is positive when y
+    increases with the row number (south-up, as in most netCDFs), so the
+    grid can be written as it is stored, without flipping it first.
+    xcoords, ycoords = 1D arrays; cell-center coordinates of the grid
+
+    output: list [raster_origin, pixel_width, pixel_height], the origin being
+      the outer corner of the first row and column
+    """
+    xcoords = np.ma.getdata(xcoords)
+    ycoords = np.ma.getdata(ycoords)
+    pwidth = float(xcoords[-1] - xcoords[0]) / max(1, len(xcoords) - 1)
+    pheight = float(ycoords[-1] - ycoords[0]) / max(1, len(ycoords) - 1)
+    origin = (float(xcoords[0]) - pwidth / 2.0, float(ycoords[0]) - pheight / 2.0)
+    return [origin, pwidth, pheight]
+
+def bbox_window(geotransform, ncols, nrows, bbox):
+    """Pixel window of a raster holding the cells whose centers fall within
+    a bounding box (see clip_slices).
+    geotransform = tuple; from GetGeoTransform()
+    ncols, nrows = integers; raster size
+    bbox = list; [minX, maxY, maxX, minY] in the raster's coordinates
+
+    output: tuple (xoff, yoff, xsize, ysize) as used by ReadAsArray
+    """
+    xcoords, ycoords = geo_coords(geotransform, ncols, nrows)
+    rows, cols = clip_slices(xcoords, ycoords, bbox)
+    return (cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+
+def raster2array(ras_name, flip=True, bbox=None, window=None, band=1, mmap=False):
+    """Convert a geoTIFF, or a window of it, to a 2D numpy array.
+    Defaults to returning the rows south-up (y increasing with the row, as
+    in most netCDFs). A north-up geoTIFF is then returned as a reversed view,
+    and one already stored south-up (positive pixel height) as it is.
+    flip = False returns the rows in the order they are stored.
+    bbox = list (optional); [minX, maxY, maxX, minY] to read (see bbox_window)
+    window = tuple (optional); pixel window (xoff, yoff, xsize, ysize) to read
+      Only the GDAL blocks intersecting a window are read.
+    band = integer; band number
+    mmap = boolean; for uncompressed rasters, return a read-only view of the
+      file mapped into memory instead of reading it, so only the pages
+      actually used are ever loaded. The view (a MappedArray) keeps the
+      raster open for as long as it, or any view of it, exists. Falls back
+      to a normal read where GDAL cannot map the file itself (compressed
+      data, some platforms).
     """
     ras_tif = gdal.Open(ras_name)
-    ras_band = ras_tif.GetRasterBand(1)
-    ras_data = ras_band.ReadAsArray()
+    ras_band = ras_tif.GetRasterBand(band)
+    geot = ras_tif.GetGeoTransform()
+    if bbox is not None:
+        window = bbox_window(geot, ras_tif.RasterXSize, ras_tif.RasterYSize, bbox)
+    if window is None:
+        window = (0, 0, ras_tif.RasterXSize, ras_tif.RasterYSize)
+    xoff, yoff, xsize, ysize = window
+    ras_data = None
+    if mmap:
+        #Only a true mapping of the file; GDAL's default implementation
+        # serves page faults through the band and works on any raster
+        try:
+            whole = ras_band.GetVirtualMemAutoArray(
+                gdal.GF_Read, options=['USE_DEFAULT_IMPLEMENTATION=NO'])
+            ras_data = whole[yoff:yoff + ysize, xoff:xoff + xsize].view(MappedArray)
+            ras_data.flags.writeable = False
+            ras_data.dataset = ras_tif
+        except (RuntimeError, AttributeError):
+            ras_data = None
+    if ras_data is None:
+        ras_data = ras_band.ReadAsArray(xoff, yoff, xsize, ysize)
+    north_up = geot[5] < 0
     ras_tif = None
-    if flip:
+    if flip and north_up:
         ras_ary = reverse(ras_data)
     else:
         ras_ary = ras_data
     return ras_ary
 
+class MappedArray(np.ndarray):
+    """numpy array viewing raster memory mapped by GDAL (see raster2array).
+    It holds the GDAL dataset in its 'dataset' attribute, and so do views
+    taken from it, so the mapping stays valid while any of them is in use.
+    """
+    def __array_finalize__(self, obj):
+        self.dataset = getattr(obj, 'dataset', None)
+
+def iter_raster_blocks(ras_name, band=1, mem_limit=MEM_LIMIT):
+    """Stream a raster band in windows of whole rows, each a whole number of
+    GDAL blocks high and at most mem_limit bytes (see raster_windows), in
+    stored row order. Nodata cells are masked.
+
+    yields: tuple (row slice, masked array block)
+    """
+    ras_tif = gdal.Open(ras_name)
+    ras_band = ras_tif.GetRasterBand(band)
+    for y0, y1 in raster_windows(ras_band, mem_limit):
+        yield slice(y0, y1), _read_window(ras_band, y0, y1)
+    ras_tif = None
+
 def array2raster(new_ras_file, array=None, *arglist):
     """Convert a 2D numpy array to a geoTIFF
     new_ras_file = string; full path and name of output tif
@@ -77,96 +602,970 @@ def array2raster(new_ras_file, array=None, *arglist):
         pixel_width = horizontal size of each pixel in the projected units
         pixel_height = vertical size of each pixel in the projected units
         NOTE - for decimal degrees in W. hemisphere, pixel_height is negative!
+        A positive pixel_height means the array is south-up with its origin
+        at minimum X and minimum Y (see raster_args); it is written north-up
+        from a reversed view, without copying the array.
 
     The defaults provided are very specific to Colorado and the datasets I use,
     so it is very likely you do not want to use them.
+    The geoTIFF is tiled and DEFLATE compressed, in EPSG:4326; use
+    write_raster for other coordinate systems, formats and stacks of bands.
 
     output: geoTIFF
     """
     if arglist == ():
-        ras_origin = [-109.375, 41.25]
-        pwidth = 0.125
-        pheight = -0.125
+        arglist = ([-109.375, 41.25], 0.125, -0.125)
+    write_raster(new_ras_file, array, *arglist)
+
+RASTER_TYPES = {'float32': 'Float32', 'float64': 'Float64', 'int16': 'Int16',
+                'uint16': 'UInt16', 'int32': 'Int32', 'uint8': 'Byte'}
+
+def write_raster(new_ras_file, arrays, raster_origin, pixel_width, pixel_height,
+                 crs=4326, nodata=-9999, dtype='float32', compress='DEFLATE',
+                 blocksize=256, overviews=True, cog=False, bandnames=None):
+    """Write one 2D array, or a stack of them as bands, to a tiled and
+    compressed geoTIFF (or Cloud Optimized geoTIFF) in a single open.
+    new_ras_file = string; full path and name of output tif
+    arrays = 2D array, 3D array [band, y, x] or list of 2D arrays. Masked
+      values are written as nodata.
+    raster_origin, pixel_width, pixel_height = as for array2raster (see
+      raster_args); a positive pixel_height writes south-up arrays north-up
+      from reversed views
+    crs = integer EPSG code, or any string osr understands (WKT, PROJ, 'EPSG:x')
+    nodata = number; nodata value of every band
+    dtype = string; data type written (see RASTER_TYPES)
+    compress = string; 'DEFLATE', 'ZSTD', 'LZW' or 'NONE'. A predictor
+      suited to the data type is used with it.
+    blocksize = integer; tile width and height
+    overviews = boolean; add averaged overviews down to about one tile
+    cog = boolean; write a Cloud Optimized geoTIFF (GDAL 3.1 or later)
+    bandnames = list of strings (optional); band descriptions
+
+    output: geoTIFF
+    """
+    if isinstance(arrays, np.ndarray) and arrays.ndim == 2:
+        arrays = [arrays]
+    rows, cols = arrays[0].shape
+    origin_x, origin_y = raster_origin
+    if pixel_height > 0:
+        origin_y = origin_y + rows * pixel_height
+        pixel_height = -pixel_height
+        arrays = [reverse(ary) for ary in arrays]
+    gdtype = gdal.GetDataTypeByName(RASTER_TYPES[np.dtype(dtype).name])
+    options = ['TILED=YES', 'BLOCKXSIZE=' + str(blocksize),
+               'BLOCKYSIZE=' + str(blocksize), 'BIGTIFF=IF_SAFER']
+    if compress.upper() != 'NONE':
+        predictor = 3 if np.dtype(dtype).kind == 'f' else 2
+        options += ['COMPRESS=' + compress.upper(), 'PREDICTOR=' + str(predictor)]
+    if cog:
+        #COGs can only be made by copying, so build the bands in memory first
+        driver = gdal.GetDriverByName('MEM')
+        out_ras = driver.Create('', cols, rows, len(arrays), gdtype)
     else:
-        ras_origin = arglist[0]
-        pwidth = arglist[1]
-        pheight = arglist[2]
-
-    cols = array.shape[1]
-    rows = array.shape[0]
-    origin_x = ras_origin[0]
-    origin_y = ras_origin[1]
-    driver = gdal.GetDriverByName('GTiff')
-    out_ras = driver.Create(new_ras_file, cols, rows, 1, gdal.GDT_Float32)
-    out_ras.SetGeoTransform((origin_x, pwidth, 0, origin_y, 0, pheight))
-    outband = out_ras.GetRasterBand(1)
-    outband.WriteArray(array)
+        driver = gdal.GetDriverByName('GTiff')
+        out_ras = driver.Create(new_ras_file, cols, rows, len(arrays), gdtype,
+                                options=options)
+    out_ras.SetGeoTransform((origin_x, pixel_width, 0, origin_y, 0, pixel_height))
     proj = osr.SpatialReference()
-    proj.ImportFromEPSG(4326)
+    if isinstance(crs, int):
+        proj.ImportFromEPSG(crs)
+    else:
+        proj.SetFromUserInput(crs)
     out_ras.SetProjection(proj.ExportToWkt())
+    for i, ary in enumerate(arrays):
+        outband = out_ras.GetRasterBand(i + 1)
+        outband.SetNoDataValue(nodata)
+        if bandnames is not None:
+            outband.SetDescription(bandnames[i])
+        if np.ma.is_masked(ary):
+            ary = ary.filled(nodata)
+        outband.WriteArray(np.ma.getdata(ary))
+    if cog:
+        #The COG driver picks the predictor for the data type itself
+        cog_options = [opt.replace('BLOCKXSIZE', 'BLOCKSIZE') for opt in options
+                       if opt.startswith(('COMPRESS', 'BLOCKX', 'BIGTIFF'))]
+        if compress.upper() != 'NONE':
+            cog_options.append('PREDICTOR=YES')
+        cog_options.append('OVERVIEWS=' + ('AUTO' if overviews else 'NONE'))
+        gdal.GetDriverByName('COG').CreateCopy(new_ras_file, out_ras,
+                                               options=cog_options)
+    elif overviews:
+        levels = []
+        while max(rows, cols) // 2**(len(levels) + 1) >= blocksize:
+            levels.append(2**(len(levels) + 1))
+        if levels:
+            out_ras.BuildOverviews('AVERAGE', levels)
+    out_ras = None
     print('Finished writing', new_ras_file)
 
-def new_nc(array, timeslice, yslice, xslice, outname, **kwargs):
-    """Save the given ndarray to a new netCDF file
-    array = The ndarray containing variable of interest. Must have 3
-      dimensions: time, y (usually latitude), and x (usually longitude).
-    timeslice = the ndarray containing the temporal values to assign to 'array'
-    yslice = the ndarray containing the vertical coordinates for 'array'
-    xslice = the ndarray containing the horizontal coordinates for 'array'
-    outname = the full path and name of the output nc file.
-    kwargs = dictionary of additional information. Keys = varname, timename,
-      xname, yname, units (of time), calendar, metadatastr (describe the dataset)
+def _array_bytes(args):
+    """Bytes held by the arrays (or lists of arrays) among some arguments"""
+    total = 0
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            total += arg.nbytes
+        elif isinstance(arg, (list, tuple)):
+            total += _array_bytes(arg)
+    return total
 
-    default kwargs provided in 'argdic'.
+class RasterWriter(object):
+    """Write rasters in background threads while the caller carries on
+    computing. GDAL releases the GIL while it compresses and writes, so the
+    writes really do run alongside the next computation.
+    The arrays waiting to be written are limited to max_bytes in total;
+    submit blocks until there is room (a single bigger job is let through on
+    its own). Errors do not stop the other writes; close() waits for all of
+    them and raises a RuntimeError listing every failure.
+    workers = integer; number of writer threads
+    max_bytes = integer; bytes of array data allowed in flight
 
-    output: a NETCDF4_CLASSIC file
+    Use as a context manager, or call close() at the end of the run:
+        with RasterWriter() as writer:
+            writer.submit(write_raster, tif, arrays, *arglist)
+    """
+    def __init__(self, workers=2, max_bytes=MEM_LIMIT):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.room = threading.Condition()
+        self.jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        #Do not hide an error raised in the with block behind write errors
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.shutdown(wait=True)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), e.g. write_raster or array2raster.
+        The arrays passed must not be changed until the write is done.
+        """
+        nbytes = _array_bytes(args) + _array_bytes(kwargs.values())
+        with self.room:
+            while self.in_flight and self.in_flight + nbytes > self.max_bytes:
+                self.room.wait()
+            self.in_flight += nbytes
+        fut = self.pool.submit(self._run, nbytes, func, *args, **kwargs)
+        self.jobs.append((args[0] if args else func.__name__, fut))
+        return fut
+
+    def _run(self, nbytes, func, *args, **kwargs):
+        """Run one write and give back its room in the queue"""
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.room:
+                self.in_flight -= nbytes
+                self.room.notify_all()
+
+    def close(self):
+        """Wait for every queued write and raise if any of them failed"""
+        self.pool.shutdown(wait=True)
+        failed = []
+        for name, fut in self.jobs:
+            err = fut.exception()
+            if err is not None:
+                text = ''.join(traceback.format_exception(type(err), err,
+                                                          err.__traceback__))
+                print('***ERROR: writing', name, 'failed\n' + text)
+                failed.append(str(name))
+        self.jobs = []
+        if failed:
+            raise RuntimeError('Failed to write: ' + ', '.join(failed))
+
+def chunk_shape(chunks, ntime, ny, nx):
+    """Resolve a chunk layout for a [time, y, x] variable.
+    chunks = None (library default), a tuple of 3 chunk lengths, or the name
+      of one of the presets:
+      'map' - one time step of up to 1024 x 1024 pixels per chunk, for
+        reading whole or partial maps.
+      'timeseries' - up to 1024 time steps of a 16 x 16 pixel tile per chunk,
+        for reading the series of single pixels or small windows.
+
+    output: tuple or None
+    """
+    if chunks is None:
+        return None
+    if ntime < 1:
+        ntime = 1024 #nothing written yet, e.g. a file compiled by appending
+    if chunks == 'map':
+        return (1, min(ny, 1024), min(nx, 1024))
+    if chunks == 'timeseries':
+        return (min(ntime, 1024), min(ny, 16), min(nx, 16))
+    if isinstance(chunks, str):
+        raise ValueError('Unknown chunk preset ' + chunks)
+    return tuple(int(c) for c in chunks)
+
+def pack_params(vmin, vmax):
+    """scale_factor and add_offset (float32, as stored) that map the range
+    [vmin, vmax] onto int16 [-32766, 32766], leaving -32767 free as the
+    fill value.
+
+    output: tuple (scale_factor, add_offset)
+    """
+    vmin = float(vmin)
+    vmax = float(vmax)
+    scale = np.float32((vmax - vmin) / 65532.0 if vmax > vmin else 1.0)
+    offset = np.float32((vmax + vmin) / 2.0)
+    #Round trip the extremes through the float32 attributes and widen the
+    # scale if rounding would pack either onto the fill value
+    ends = np.array([vmin, vmax], dtype=np.float32)
+    while np.abs(np.around((ends - offset) / scale)).max() > 32766:
+        scale = np.nextafter(scale, np.float32(np.inf))
+    return scale, offset
+
+def create_nc(timeslice, yslice, xslice, outname, **kwargs):
+    """Create a new netCDF file with time, y and x coordinates and an empty
+    [time, y, x] variable, ready to be filled in (e.g. by derive_var).
+    timeslice = the ndarray containing the temporal values
+    yslice = the ndarray containing the vertical coordinates
+    xslice = the ndarray containing the horizontal coordinates
+    outname = the full path and name of the output nc file.
+    kwargs = dictionary of additional information, same as new_nc.
+
+    output: tuple (open netCDF4 Dataset, the new data variable). Close the
+      Dataset when done.
     """
     argdic = {'varname':'var', 'timename':'time', 'xname':'longitude',
               'yname':'latitude', 'units':'days since 1950-01-01 00:00:00',
               'calendar':'gregorian',
-              'metadatastr':''}
-    #FIXME: right now there is no error checking regarding shape of array
-    # (or anything else for that matter). Assumes dimensions are [time, y, x]
-    x = array.shape[2]
-    y = array.shape[1]
-    if kwargs != {}:
-        if 'varname' in kwargs:
-            argdic['varname'] = kwargs['varname']
-        if 'timename' in kwargs:
-            argdic['timename'] = kwargs['timename']
-        if 'xname' in kwargs:
-            argdic['xname'] = kwargs['xname']
-        if 'yname' in kwargs:
-            argdic['yname'] = kwargs['yname']
-        if 'units' in kwargs:
-            argdic['units'] = kwargs['units']
-        if 'calendar' in kwargs:
-            argdic['calendar'] = kwargs['calendar']
-        if 'metadatastr' in kwargs:
-            argdic['metadatastr'] = kwargs['metadatastr']
+              'metadatastr':'', 'chunks':None, 'zlib':False, 'complevel':4,
+              'shuffle':True, 'least_significant_digit':None,
+              'pack_range':None, 'fill_value':None}
+    unknown = set(kwargs).difference(argdic)
+    if unknown:
+        raise TypeError('Unknown keyword(s): ' + ', '.join(sorted(unknown)))
+    argdic.update(kwargs)
+    ntime = len(timeslice)
+    chunks = chunk_shape(argdic['chunks'], ntime, len(yslice), len(xslice))
+    if argdic['pack_range'] is not None:
+        dtype = 'i2'
+        fill = -32767 if argdic['fill_value'] is None else argdic['fill_value']
+    else:
+        dtype = 'f4'
+        fill = argdic['fill_value']
     out_ds = Dataset(outname, 'w', format='NETCDF4_CLASSIC')
     out_ds.createDimension(argdic['timename'], None)
-    out_ds.createDimension(argdic['yname'], y)
-    out_ds.createDimension(argdic['xname'], x)
+    out_ds.createDimension(argdic['yname'], len(yslice))
+    out_ds.createDimension(argdic['xname'], len(xslice))
     time_var = out_ds.createVariable(argdic['timename'], 'f8', (argdic['timename'],))
     lat_var = out_ds.createVariable(argdic['yname'], 'f4', (argdic['yname'],))
     lon_var = out_ds.createVariable(argdic['xname'], 'f4', (argdic['xname'],))
-    cvar = out_ds.createVariable(argdic['varname'], 'f4',
+    cvar = out_ds.createVariable(argdic['varname'], dtype,
                                  (argdic['timename'], argdic['yname'],
-                                  argdic['xname'],))
+                                  argdic['xname'],),
+                                 zlib=argdic['zlib'], complevel=argdic['complevel'],
+                                 shuffle=argdic['shuffle'], chunksizes=chunks,
+                                 least_significant_digit=argdic['least_significant_digit'],
+                                 fill_value=fill)
+    if argdic['pack_range'] is not None:
+        scale, offset = pack_params(*argdic['pack_range'])
+        cvar.setncatts({u'scale_factor': scale, u'add_offset': offset})
     time_var[:] = timeslice
     lon_var[:] = xslice
     lat_var[:] = yslice
-    cvar[:] = array
     ds_att = {u'description': argdic['metadatastr'],
               u'history': 'Created ' + time.ctime(time.time())}
     time_att = {u'units': argdic['units'], u'calendar': argdic['calendar']}
     out_ds.setncatts(ds_att)
     time_var.setncatts(time_att)
+    return out_ds, cvar
+
+def new_nc(array, timeslice, yslice, xslice, outname, **kwargs):
+    """Save the given ndarray to a new netCDF file
+    array = The ndarray containing variable of interest. Must have 3
+      dimensions: time, y (usually latitude), and x (usually longitude).
+      Can also be an iterator of [time, y, x] blocks in time order (e.g. a
+      generator reading one input file at a time), which are written as
+      they arrive so the whole array never has to be in memory.
+    timeslice = the ndarray containing the temporal values to assign to 'array'
+    yslice = the ndarray containing the vertical coordinates for 'array'
+    xslice = the ndarray containing the horizontal coordinates for 'array'
+    outname = the full path and name of the output nc file.
+    kwargs = dictionary of additional information. Keys = varname, timename,
+      xname, yname, units (of time), calendar, metadatastr (describe the dataset)
+      Storage options:
+      chunks = chunk shape tuple or preset, 'map' or 'timeseries' (see
+        chunk_shape)
+      zlib = True to deflate the data variable; complevel = 1-9 (default 4);
+        shuffle = byte shuffle before deflating (default True)
+      least_significant_digit = integer; quantize to this many decimal
+        digits, which makes the data compress much better
+      pack_range = tuple (min, max); store as int16 with scale_factor and
+        add_offset covering this range. Use 'auto' to take it from array
+        (not possible for an iterator).
+      fill_value = number; missing value marker
+
+    default kwargs provided in 'argdic' of create_nc.
+
+    output: a NETCDF4_CLASSIC file
+    """
+    #FIXME: right now there is no error checking regarding shape of array
+    # (or anything else for that matter). Assumes dimensions are [time, y, x]
+    if isinstance(kwargs.get('pack_range'), str):
+        if not hasattr(array, 'shape'):
+            raise ValueError("pack_range='auto' needs an array, not an iterator")
+        kwargs = dict(kwargs, pack_range=(np.ma.min(array), np.ma.max(array)))
+    out_ds, cvar = create_nc(timeslice, yslice, xslice, outname, **kwargs)
+    if hasattr(array, 'shape'):
+        cvar[:] = array
+    else:
+        tidx = 0
+        for block in array:
+            cvar[tidx:tidx + block.shape[0]] = block
+            tidx += block.shape[0]
     out_ds.sync()
     out_ds.close()
     print('Created', outname)
 
+def block_mean(*blocks):
+    """Elementwise mean of same-shaped blocks, e.g. tmean from tasmax and
+    tasmin. For use as the func of derive_var.
+    """
+    total = np.ma.array(blocks[0], dtype=np.float32, copy=True)
+    for blk in blocks[1:]:
+        total += blk
+    total /= len(blocks)
+    return total
+
+def derive_var(func, invars, out, mem_limit=MEM_LIMIT):
+    """Compute a derived variable one block at a time.
+    func = function; takes one block from each input variable (in the order
+      of invars) and returns the derived block of the same shape.
+    invars = list of same-shaped [time, y, x] netCDF variables or arrays
+    out = preallocated ndarray or netCDF variable [time, y, x] to write into
+    mem_limit = integer; bytes of input to hold at once, shared by all invars
+
+    output: out, filled in.
+    """
+    shape = tuple(invars[0].shape)
+    for avar in invars[1:]:
+        if tuple(avar.shape) != shape:
+            raise ValueError('Input variables must all have the same shape')
+    itemsize = sum(np.dtype(avar.dtype).itemsize + 1 for avar in invars)
+    for times, rows in iter_slices(shape, itemsize, mem_limit):
+        blocks = [avar[times, rows, :] for avar in invars]
+        out[times, rows, :] = func(*blocks)
+    return out
+
+def derive_nc(func, invars, timeslice, yslice, xslice, outname,
+              mem_limit=MEM_LIMIT, **kwargs):
+    """Write a derived variable straight into a new netCDF file, one block
+    at a time (see derive_var and create_nc for the arguments).
+
+    output: a NETCDF4_CLASSIC file
+    """
+    out_ds, cvar = create_nc(timeslice, yslice, xslice, outname, **kwargs)
+    derive_var(func, invars, cvar, mem_limit)
+    out_ds.sync()
+    out_ds.close()
+    print('Created', outname)
+
+def convert_times(tvar, units, calendar):
+    """Values of a netCDF time variable expressed in other units/calendar"""
+    times = tvar[:]
+    tcalen = getattr(tvar, 'calendar', 'standard')
+    if tvar.units == units and tcalen == calendar:
+        return times
+    return date2num(num2date(times, tvar.units, tcalen), units, calendar)
+
+MANIFEST_ATT = 'compiled_sources'
+
+def read_manifest(ncname):
+    """List of [source file name, time steps] already appended to a file
+    made by compile_nc (empty if there is none).
+    """
+    with Dataset(ncname) as dset:
+        if MANIFEST_ATT not in dset.ncattrs():
+            return []
+        return json.loads(dset.getncattr(MANIFEST_ATT))
+
+def compile_nc(sources, outname, varname, rows=slice(None), cols=slice(None),
+               convert=None, mem_limit=MEM_LIMIT, src_time='time', src_x='lon',
+               src_y='lat', xoffset=0.0, **kwargs):
+    """Compile a series of netCDF files (e.g. one per year) into one clipped
+    [time, y, x] netCDF, in a way that can be stopped and restarted.
+
+    Every source is appended in large chunk-aligned blocks. Only once it is
+    completely written and synced is it recorded in the output's
+    'compiled_sources' attribute, together with its number of time steps.
+    Running compile_nc again with the same sources skips the ones already
+    recorded and resumes right after the last committed one, overwriting
+    anything a crashed run left behind. Time values are taken from each
+    source and converted to the output's units and calendar.
+    sources = list of source file paths, in time order
+    outname = the full path and name of the output nc file
+    varname = string; name of the variable in the source files
+    rows, cols = slices of the source y and x dimensions to keep
+    convert = function (optional); applied to each block of data, e.g. to
+      convert Kelvin to Celsius
+    mem_limit = integer; bytes of source data to read at once
+    src_time, src_x, src_y = strings; coordinate variable names in the sources
+    xoffset = number; added to the x coordinates (e.g. -360 for 0-360 longitudes)
+    kwargs = passed to create_nc when the output is first created. The time
+      units and calendar default to those of the first source.
+
+    output: list of the sources appended by this call
+    """
+    added = _compile(sources, {outname: (rows, cols)}, varname, convert,
+                     mem_limit, src_time, src_x, src_y, xoffset, **kwargs)
+    return added[outname]
+
+def compile_regions(sources, regions, varname, convert=None, mem_limit=MEM_LIMIT,
+                    src_time='time', src_x='lon', src_y='lat', xoffset=0.0,
+                    **kwargs):
+    """Compile a series of netCDF files into one clipped netCDF per region,
+    reading each source only once for all the regions (see compile_nc, which
+    this generalizes; every output is resumable on its own).
+    sources = list of source file paths, in time order
+    regions = dictionary; {output nc file: bounding box [minX, maxY, maxX, minY]}
+      in the sources' coordinates (-180 to 180 boxes also work on 0-360 grids)
+    varname, convert, mem_limit, src_time, src_x, src_y, xoffset, kwargs =
+      as for compile_nc
+
+    output: dictionary; {output nc file: list of the sources appended}
+    """
+    names = list(regions.keys())
+    with Dataset(sources[0]) as first:
+        plans = clip_plan(first.variables[src_x][:], first.variables[src_y][:],
+                          [regions[name] for name in names])
+    return _compile(sources, dict(zip(names, plans)), varname, convert,
+                    mem_limit, src_time, src_x, src_y, xoffset, **kwargs)
+
+def _compile(sources, targets, varname, convert, mem_limit, src_time, src_x,
+             src_y, xoffset, **kwargs):
+    """Engine of compile_nc and compile_regions.
+    targets = dictionary; {output nc file: (rows, cols) slices of the sources}
+    """
+    names = [os.path.basename(src) for src in sources]
+    outnames = [out for out in targets if not os.path.isfile(out)]
+    if outnames:
+        with Dataset(sources[0]) as first:
+            tvar = first.variables[src_time]
+            ncargs = {'varname': varname, 'units': tvar.units,
+                      'calendar': getattr(tvar, 'calendar', 'standard')}
+            ncargs.update(kwargs)
+            for outname in outnames:
+                rows, cols = targets[outname]
+                xslice = first.variables[src_x][cols] + xoffset
+                yslice = first.variables[src_y][rows]
+                out_ds, cvar = create_nc(np.zeros(0), yslice, xslice, outname,
+                                         **ncargs)
+                out_ds.setncattr(MANIFEST_ATT, '[]')
+                out_ds.close()
+    outputs = {}
+    added = {}
+    try:
+        for outname in targets:
+            out_ds = Dataset(outname, 'a')
+            outputs[outname] = out_ds
+            done = json.loads(out_ds.getncattr(MANIFEST_ATT))
+            if [entry[0] for entry in done] != names[:len(done)]:
+                raise ValueError(outname + ' was compiled from a different list of sources')
+            added[outname] = []
+        start = min(len(json.loads(ds.getncattr(MANIFEST_ATT))) for ds in outputs.values())
+        for src, name in zip(sources[start:], names[start:]):
+            #The outputs that still need this source
+            todo = []
+            for outname, out_ds in outputs.items():
+                done = json.loads(out_ds.getncattr(MANIFEST_ATT))
+                if len(done) == names.index(name):
+                    todo.append((outname, out_ds, done))
+            with Dataset(src) as dset:
+                svar = dset.variables[varname]
+                stime = dset.variables[src_time]
+                itemsize = np.dtype(svar.dtype).itemsize + 1
+                chunks = var_chunks(svar)
+                boxes = {}
+                for outname, _, _ in todo:
+                    rows, cols = targets[outname]
+                    boxes[outname] = [sl.indices(n)[:2] for sl, n
+                                      in zip((rows, cols), svar.shape[1:])]
+                #Stream the area spanned by all the regions in blocks and
+                #cut each region's piece out of every block
+                y0 = min(box[0][0] for box in boxes.values())
+                y1 = max(box[0][1] for box in boxes.values())
+                x0 = min(box[1][0] for box in boxes.values())
+                x1 = max(box[1][1] for box in boxes.values())
+                shape = (svar.shape[0], y1 - y0, x1 - x0)
+                if chunks is not None:
+                    tstep, ystep = block_plan(shape, itemsize, mem_limit, chunks)
+                    fit_chunk_cache(svar, (-(-ystep // chunks[1]) + 1) *
+                                    (len(chunk_spans(x0, x1, chunks[2])) + 1), mem_limit)
+                for tsl, rsl in iter_slices(shape, itemsize, mem_limit, chunks):
+                    brows = slice(y0 + rsl.start, y0 + rsl.stop)
+                    block = read_clip(svar, tsl, brows, slice(x0, x1), nan=True)
+                    if convert is not None:
+                        block = convert(block)
+                    #Missing values go back to the fill value on writing
+                    block = np.ma.masked_invalid(block, copy=False)
+                    for outname, out_ds, done in todo:
+                        (ra, rb), (ca, cb) = boxes[outname]
+                        srows = slice(max(ra, brows.start), min(rb, brows.stop))
+                        if srows.start >= srows.stop:
+                            continue
+                        piece = block[:, srows.start - brows.start:srows.stop - brows.start,
+                                      ca - x0:cb - x0]
+                        offset = sum(entry[1] for entry in done)
+                        orows = slice(srows.start - ra, srows.stop - ra)
+                        out_var = out_ds.variables[kwargs.get('varname', varname)]
+                        out_var[offset + tsl.start:offset + tsl.stop, orows, :] = piece
+                for outname, out_ds, done in todo:
+                    timename = [dim for dim in out_ds.dimensions.values()
+                                if dim.isunlimited()][0].name
+                    out_time = out_ds.variables[timename]
+                    times = convert_times(stime, out_time.units, out_time.calendar)
+                    offset = sum(entry[1] for entry in done)
+                    out_time[offset:offset + len(times)] = times
+                    done.append([name, len(times)])
+                    out_ds.sync()
+                    #Only now is the source committed
+                    out_ds.setncattr(MANIFEST_ATT, json.dumps(done))
+                    out_ds.sync()
+                    added[outname].append(src)
+                    print('Appended', name, 'to', outname)
+    finally:
+        for out_ds in outputs.values():
+            out_ds.close()
+    return added
+
+def _to_slice(key, length):
+    """Turn an integer or slice index into (slice, True if it was an integer)"""
+    if isinstance(key, slice):
+        return key, False
+    key = int(key)
+    if key < 0:
+        key += length
+    if not 0 <= key < length:
+        raise IndexError('index ' + str(key) + ' is out of bounds')
+    return slice(key, key + 1), True
+
+class AggVariable(object):
+    """A [time, y, x] variable split over several netCDF files (NETCDF4 or
+    NETCDF3, e.g. one file per year or per 5 years), presented as a single
+    variable along time without copying anything. A replacement for
+    MFDataset, which only handles NETCDF3/NETCDF4_CLASSIC.
+
+    Slicing it (agg[t0:t1, y0:y1, x0:x1]) reads only the files and the
+    chunk-aligned pieces needed (see read_clip). An optional clip window and
+    unit conversion are applied on the fly, so the result can be used
+    anywhere a netCDF variable is, e.g. with iter_blocks, derive_var or
+    watyrcalcs.season_products.
+    sources = list of file paths, in time order
+    varname = string; name of the variable in every file
+    rows, cols = slices of the y and x dimensions to present (the clip)
+    convert = function (optional); applied to every block that is read,
+      e.g. to convert Kelvin to Celsius
+    src_time, src_x, src_y = strings; coordinate variable names in the files
+    xoffset = number; added to the x coordinates (e.g. -360 for 0-360 longitudes)
+    units, calendar = strings (optional); time units/calendar for the times
+      attribute, default those of the first file
+
+    attributes: shape, dtype, times, units, calendar, xcoords, ycoords
+    """
+    def __init__(self, sources, varname, rows=slice(None), cols=slice(None),
+                 convert=None, src_time='time', src_x='lon', src_y='lat',
+                 xoffset=0.0, units=None, calendar=None):
+        self.sources = list(sources)
+        self.varname = varname
+        self.convert = convert
+        self.datasets = [Dataset(src) for src in self.sources]
+        try:
+            first = self.datasets[0]
+            tvar = first.variables[src_time]
+            self.units = units or tvar.units
+            self.calendar = calendar or getattr(tvar, 'calendar', 'standard')
+            fullshape = first.variables[varname].shape
+            self.rows = slice(*rows.indices(fullshape[1])[:2])
+            self.cols = slice(*cols.indices(fullshape[2])[:2])
+            self.xcoords = first.variables[src_x][self.cols] + xoffset
+            self.ycoords = first.variables[src_y][self.rows]
+            #The type slices come back in (unpacked floats for packed int16)
+            self.dtype = first.variables[varname][:0].dtype
+            self.vars = [dset.variables[varname] for dset in self.datasets]
+            times = [convert_times(dset.variables[src_time], self.units, self.calendar)
+                     for dset in self.datasets]
+        except Exception:
+            self.close()
+            raise
+        lengths = [len(tms) for tms in times]
+        self.times = np.ma.concatenate(times)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.shape = (int(self.offsets[-1]), self.rows.stop - self.rows.start,
+                      self.cols.stop - self.cols.start)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all the underlying files"""
+        for dset in self.datasets:
+            if dset.isopen():
+                dset.close()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            pos = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:pos] + (slice(None),) * (4 - len(key)) + key[pos + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError('AggVariable takes at most 3 indices')
+        (tkey, tint), (ykey, yint), (xkey, xint) = [
+            _to_slice(k, n) for k, n in zip(key, self.shape)]
+        tidx = np.arange(*tkey.indices(self.shape[0]))
+        ystart, ystop, ystep = ykey.indices(self.shape[1])
+        xstart, xstop, xstep = xkey.indices(self.shape[2])
+        if ystep < 0 or xstep < 0:
+            raise IndexError('Negative steps are only supported along time')
+        rows = slice(self.rows.start + ystart, self.rows.start + ystop, ystep)
+        cols = slice(self.cols.start + xstart, self.cols.start + xstop, xstep)
+        fileidx = np.searchsorted(self.offsets, tidx, side='right') - 1
+        pieces = []
+        for start, stop, fnum in zip(*label_runs(fileidx)):
+            local = tidx[start:stop] - self.offsets[fnum]
+            avar = self.vars[fnum]
+            if ystep == 1 and xstep == 1 and np.all(np.diff(local) == 1):
+                block = read_clip(avar, slice(local[0], local[-1] + 1), rows, cols)
+            else:
+                order = np.argsort(local)
+                block = avar[local[order], rows, cols]
+                block = block[np.argsort(order)]
+            pieces.append(block)
+        if pieces:
+            out = np.ma.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+        else:
+            out = np.ma.zeros((0, len(range(ystart, ystop, ystep)),
+                               len(range(xstart, xstop, xstep))), dtype=self.dtype)
+        if self.convert is not None:
+            out = self.convert(out)
+        squeeze = tuple(ax for ax, isint in enumerate((tint, yint, xint)) if isint)
+        if squeeze:
+            out = out.reshape([n for ax, n in enumerate(out.shape) if ax not in squeeze])
+        return out
+
+def nearest_index(coords, values):
+    """Index of the grid cell nearest to each value along one axis.
+    coords = 1D array of cell-center coordinates, increasing or decreasing
+      and evenly spaced (e.g. a netCDF latitude or longitude variable)
+    values = number or array of coordinates to look up
+
+    output: integer ndarray of indices, -1 where a value falls outside the
+      grid (more than half a cell beyond the outer centers) or is not finite
+    """
+    coords = np.asarray(np.ma.getdata(coords), dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    descending = coords.size > 1 and coords[0] > coords[-1]
+    if descending:
+        coords = coords[::-1]
+    pos = np.clip(np.searchsorted(coords, values), 1, max(1, coords.size - 1))
+    left = coords[pos - 1]
+    right = coords[np.minimum(pos, coords.size - 1)]
+    idx = np.where(np.abs(values - left) <= np.abs(right - values), pos - 1, pos)
+    idx = np.minimum(idx, coords.size - 1)
+    half = abs(coords[1] - coords[0]) / 2.0 if coords.size > 1 else np.inf
+    outside = ((values < coords[0] - half) | (values > coords[-1] + half) |
+               ~np.isfinite(values))
+    if descending:
+        idx = coords.size - 1 - idx
+    return np.where(outside, -1, idx)
+
+def rechunk_timeseries(innc, outnc, varname, tile=(16, 16), mem_limit=MEM_LIMIT,
+                       **kwargs):
+    """Copy a [time, y, x] netCDF (e.g. one made by new_nc or compile_nc) to
+    a pixel-major layout, where each chunk holds the full time series of a
+    small tile of pixels. Reading the series of one pixel or a small window
+    from the copy (see PixelStore) then touches a single chunk instead of
+    every time step's chunk.
+
+    The input is read in bands of whole tile rows over the full time range,
+    as many rows as fit in mem_limit, so each output chunk is written once.
+    innc = string; input nc file
+    outnc = string; output nc file
+    varname = string; the [time, y, x] variable to copy
+    tile = tuple; (rows, cols) of pixels per chunk
+    mem_limit = integer; bytes of input to hold at once
+    kwargs = passed on to create_nc (e.g. zlib=True)
+
+    output: a NETCDF4_CLASSIC file
+    """
+    with Dataset(innc) as in_ds:
+        invar = in_ds.variables[varname]
+        tname, yname, xname = invar.dimensions
+        tvar = in_ds.variables[tname]
+        ntime, nrows, ncols = invar.shape
+        ncargs = {'varname': varname, 'timename': tname, 'yname': yname,
+                  'xname': xname, 'units': tvar.units,
+                  'calendar': getattr(tvar, 'calendar', 'standard'),
+                  'metadatastr': getattr(in_ds, 'description', ''),
+                  'chunks': (ntime, min(tile[0], nrows), min(tile[1], ncols))}
+        ncargs.update(kwargs)
+        out_ds, cvar = create_nc(tvar[:], in_ds.variables[yname][:],
+                                 in_ds.variables[xname][:], outnc, **ncargs)
+        try:
+            row_bytes = ntime * ncols * (np.dtype(invar.dtype).itemsize + 1)
+            band = max(1, mem_limit // max(1, row_bytes))
+            if band >= tile[0]:
+                band -= band % tile[0]
+            for y0 in range(0, nrows, band):
+                rows = slice(y0, min(y0 + band, nrows))
+                cvar[:, rows, :] = read_clip(invar, rows=rows)
+            out_ds.setncattr('layout', 'pixel-major')
+        finally:
+            out_ds.close()
+    print('Created', outnc)
+
+class PixelStore(object):
+    """Fast access to the time series of single pixels or small windows of
+    a [time, y, x] netCDF, ideally one written by rechunk_timeseries.
+    ncname = string; the nc file
+    varname = string; the [time, y, x] variable
+
+    attributes: times, units, calendar, xcoords, ycoords, var
+    """
+    def __init__(self, ncname, varname):
+        self.dataset = Dataset(ncname)
+        self.var = self.dataset.variables[varname]
+        tname, yname, xname = self.var.dimensions
+        tvar = self.dataset.variables[tname]
+        self.times = tvar[:]
+        self.units = tvar.units
+        self.calendar = getattr(tvar, 'calendar', 'standard')
+        self.ycoords = self.dataset.variables[yname][:]
+        self.xcoords = self.dataset.variables[xname][:]
+        #A few tiles' worth of cache is all that is needed for point reads
+        fit_chunk_cache(self.var, 16)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the nc file"""
+        if self.dataset.isopen():
+            self.dataset.close()
+
+    def index(self, x, y):
+        """Row and column of the pixel containing coordinates x, y"""
+        row = int(nearest_index(self.ycoords, y))
+        col = int(nearest_index(self.xcoords, x))
+        if row < 0 or col < 0:
+            raise IndexError('Point ' + str((x, y)) + ' is outside the grid')
+        return row, col
+
+    def series(self, x, y):
+        """Full time series [time] of the pixel containing coordinates x, y"""
+        row, col = self.index(x, y)
+        return self.var[:, row, col]
+
+    def window(self, x, y, size=3):
+        """Full time series [time, size, size] of the window of pixels
+        centered on coordinates x, y (clipped at the grid edges).
+        """
+        row, col = self.index(x, y)
+        half = size // 2
+        return self.var[:, max(0, row - half):row + half + 1,
+                        max(0, col - half):col + half + 1]
+
+def sample_points(var, xcoords, ycoords, x, y, tile=(256, 256), index=None):
+    """Values of a [y, x] or [band, y, x] grid at many points, reading each
+    storage chunk the points fall in only once. Points are sorted by the
+    chunk (or tile, for plain arrays and contiguous variables) they fall in
+    and each chunk is read as the bounding box of its points over all bands,
+    so the cost depends on the chunks touched, not on the number of points.
+    var = netCDF4 Variable, AggVariable or (masked) array; [y, x] or
+      [band, y, x], e.g. season products stacked by band
+    xcoords, ycoords = 1D arrays; cell-center coordinates of the grid
+    x, y = arrays; point coordinates, in the grid's coordinate system
+    tile = tuple; (rows, cols) to group points by when var is not chunked
+    index = tuple (optional); (rows, cols) of the points already found with
+      nearest_index, to skip the lookup
+
+    output: masked array [points] or [band, points]; points outside the
+      grid are masked
+    """
+    if index is None:
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        index = (nearest_index(ycoords, y), nearest_index(xcoords, x))
+    rows, cols = index
+    lead = tuple(var.shape[:-2])
+    #The type slices come back in (unpacked floats for packed int16)
+    dtype = np.ma.getdata(var[..., :0, :0]).dtype
+    data = np.zeros(lead + (rows.size,), dtype=dtype)
+    mask = np.ones(lead + (rows.size,), dtype=bool)
+    inside = np.flatnonzero((rows >= 0) & (cols >= 0))
+    chunks = var_chunks(var)
+    ty, tx = chunks[-2:] if chunks is not None else tile
+    if chunks is not None:
+        fit_chunk_cache(var, 1)
+    #Sort the points by chunk, then walk the runs of points sharing one
+    tileid = (rows[inside] // ty) * (-(-var.shape[-1] // tx)) + cols[inside] // tx
+    order = np.argsort(tileid, kind='stable')
+    inside, tileid = inside[order], tileid[order]
+    for start, stop, _ in zip(*label_runs(tileid)):
+        pts = inside[start:stop]
+        prow, pcol = rows[pts], cols[pts]
+        r0, c0 = prow.min(), pcol.min()
+        blk = var[..., r0:prow.max() + 1, c0:pcol.max() + 1]
+        vals = blk[..., prow - r0, pcol - c0]
+        data[..., pts] = np.ma.getdata(vals)
+        mask[..., pts] = np.ma.getmaskarray(vals)
+    return np.ma.array(data, mask=mask, copy=False)
+
+def sample_many(layers, xcoords, ycoords, x, y, tile=(256, 256)):
+    """Sample many grids at the same points in one call (see sample_points),
+    e.g. to build an SDM covariate table. The grid cells of the points are
+    looked up once and shared by all the layers.
+    layers = dictionary; {name: grid} or {name: (grid, band names)}.
+      A [y, x] grid gives one column called name, a [band, y, x] grid one
+      column per band called bandname_name (e.g. 's1_pr_HADGEM2_ES'), or
+      0_name, 1_name, ... if no band names are given.
+    xcoords, ycoords = 1D arrays; cell-center coordinates shared by the grids
+    x, y = arrays; point coordinates
+
+    output: dictionary; {column name: masked array [points]}
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    index = (nearest_index(ycoords, y), nearest_index(xcoords, x))
+    table = {}
+    for name, grid in layers.items():
+        bands = None
+        if isinstance(grid, tuple):
+            grid, bands = grid
+        vals = sample_points(grid, xcoords, ycoords, x, y, tile, index)
+        if vals.ndim == 1:
+            table[name] = vals
+            continue
+        vals = vals.reshape(-1, vals.shape[-1])
+        if bands is None:
+            bands = [str(i) for i in range(vals.shape[0])]
+        for band, row in zip(bands, vals):
+            table[str(band) + '_' + name] = row
+    return table
+
+def _limit_memory(mem_cap):
+    """Process pool initializer; caps the address space of a worker process.
+    Only possible where the resource module exists (i.e. not on Windows).
+    """
+    if mem_cap:
+        try:
+            import resource
+        except ImportError:
+            return
+        resource.setrlimit(resource.RLIMIT_AS, (int(mem_cap), int(mem_cap)))
+
+def run_jobs(func, jobs, workers=None, mem_cap=None):
+    """Run independent jobs, such as compiling one output netCDF each, on a
+    pool of worker processes. A job that fails does not stop the others;
+    all failures are reported once every job has finished.
+    func = function to run; must be defined at module level so it can be
+      sent to the workers. Call run_jobs from inside an
+      'if __name__ == "__main__":' block of the calling script.
+    jobs = list of argument tuples, one per call of func
+    workers = integer; number of worker processes (defaults to the number of
+      CPUs). With 1 the jobs run one after another in this process.
+    mem_cap = integer (optional); bytes of memory each worker may use. A job
+      that needs more fails with a MemoryError. Ignored on Windows and when
+      workers is 1.
+
+    output: dictionary of the jobs that failed; argument tuple -> error text
+    """
+    jobs = [tuple(args) for args in jobs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    failed = {}
+    if workers == 1:
+        for args in jobs:
+            try:
+                func(*args)
+            except Exception:
+                failed[args] = traceback.format_exc()
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, max(1, len(jobs))),
+                                 initializer=_limit_memory,
+                                 initargs=(mem_cap,)) as pool:
+            futures = [(args, pool.submit(func, *args)) for args in jobs]
+            for args, fut in futures:
+                try:
+                    fut.result()
+                except Exception:
+                    failed[args] = traceback.format_exc()
+    for args, err in failed.items():
+        print('***ERROR: job', args, 'failed\n' + err)
+    print('Finished', len(jobs) - len(failed), 'of', len(jobs), 'jobs')
+    return failed
+
+def clip_slices(xcoords, ycoords, bbox):
+    """Row and column slices of the cells whose centers fall within a
+    bounding box, found by searching the grid's own coordinate arrays, so
+    uneven spacing and y running either way are handled. A bounding box in
+    -180 to 180 longitudes is shifted to match a grid in 0 to 360 ones
+    (e.g. MACA).
+    xcoords, ycoords = 1D arrays; cell-center coordinates of the grid
+    bbox = list; [minX, maxY, maxX, minY] of the area to clip
+
+    output: tuple of slices (rows, cols), empty if the box misses the grid
+    """
+    xcoords = np.asarray(np.ma.getdata(xcoords), dtype=np.float64)
+    ycoords = np.asarray(np.ma.getdata(ycoords), dtype=np.float64)
+    minx, maxy, maxx, miny = [float(val) for val in bbox]
+    if xcoords.max() > 180.0 and minx < 0.0:
+        minx, maxx = minx + 360.0, maxx + 360.0
+    return (_coord_slice(ycoords, miny, maxy), _coord_slice(xcoords, minx, maxx))
+
+def _coord_slice(coords, low, high):
+    """Slice of the coordinates (increasing or decreasing) within [low, high]"""
+    #Allow for round-off in coordinates stored as float32
+    tol = 1e-6 * abs(coords[-1] - coords[0]) / max(1, coords.size - 1)
+    if coords.size > 1 and coords[0] > coords[-1]:
+        rev = coords[::-1]
+        start = coords.size - np.searchsorted(rev, high + tol, 'right')
+        stop = coords.size - np.searchsorted(rev, low - tol, 'left')
+    else:
+        start = np.searchsorted(coords, low - tol, 'left')
+        stop = np.searchsorted(coords, high + tol, 'right')
+    return slice(int(start), int(max(start, stop)))
+
+_PLAN_CACHE = {}
+
+def clip_plan(xcoords, ycoords, bboxes):
+    """clip_slices for many bounding boxes on one grid. Plans are cached per
+    grid (its size and end coordinates) and list of boxes, so every source
+    file of a series sharing the grid reuses them.
+    bboxes = list of [minX, maxY, maxX, minY] bounding boxes
+
+    output: list of (rows, cols) slice tuples, one per bounding box
+    """
+    xcoords = np.ma.getdata(xcoords)
+    ycoords = np.ma.getdata(ycoords)
+    key = (xcoords.size, float(xcoords[0]), float(xcoords[-1]), ycoords.size,
+           float(ycoords[0]), float(ycoords[-1]),
+           tuple(tuple(float(val) for val in bbox) for bbox in bboxes))
+    if key not in _PLAN_CACHE:
+        _PLAN_CACHE[key] = [clip_slices(xcoords, ycoords, bbox) for bbox in bboxes]
+    return _PLAN_CACHE[key]
+
+def nc_clip_plan(ncname, bboxes, src_x='lon', src_y='lat'):
+    """clip_plan using the coordinate variables of a netCDF file"""
+    with Dataset(ncname) as dset:
+        return clip_plan(dset.variables[src_x][:], dset.variables[src_y][:], bboxes)
+
 def clipindex_fromXY(full_uleft, full_lright, uleft, lright, stepx, stepy=None):
     """
     Gets the XY index values of a smaller area than a netCDF's full extent. Use
@@ -193,10 +1592,90 @@ def clipindex_fromXY(full_uleft, full_lright, uleft, lright, stepx, stepy=None):
 
     return([clip_idx_x1, clip_idx_y1, clip_idx_x2, clip_idx_y2])
 
+def geo_coords(geotransform, ncols, nrows):
+    """1D cell-center x and y coordinates of a (non-rotated) raster.
+    geotransform = tuple; from GetGeoTransform()
+    ncols, nrows = integers; raster size
+
+    output: tuple of float64 arrays (x coordinates, y coordinates), the y
+      ones running in row order (decreasing for a north-up raster)
+    """
+    origin_x, pwidth, _, origin_y, _, pheight = geotransform
+    xcoords = origin_x + (np.arange(ncols) + 0.5) * pwidth
+    ycoords = origin_y + (np.arange(nrows) + 0.5) * pheight
+    return xcoords, ycoords
+
+def raster_windows(band, mem_limit=MEM_LIMIT):
+    """Bands of whole rows to read a GDAL raster band in, each a whole
+    number of the band's storage blocks high and at most mem_limit bytes.
+
+    yields: tuple (first row, row after the last)
+    """
+    bheight = band.GetBlockSize()[1]
+    itemsize = gdal.GetDataTypeSize(band.DataType) // 8 + 1 #allow for a mask
+    nrows = max(1, mem_limit // max(1, band.XSize * itemsize))
+    nrows = max(bheight, nrows - nrows % bheight)
+    for y0 in range(0, band.YSize, nrows):
+        yield y0, min(y0 + nrows, band.YSize)
+
+def _read_window(band, y0, y1):
+    """Rows y0 to y1 of a GDAL raster band, nodata masked"""
+    ary = band.ReadAsArray(0, y0, band.XSize, y1 - y0)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        ary = np.ma.masked_equal(ary, nodata, copy=False)
+    return ary
+
+def rasters2nc(rasters, outname, timeslice, mem_limit=MEM_LIMIT, **kwargs):
+    """Stream a multi-band raster, or a time-ordered list of rasters (e.g.
+    decades of monthly PRISM geotiffs), into a [time, y, x] netCDF without
+    holding more than mem_limit bytes of it at once. Every band is one time
+    step, read in windows of whole GDAL blocks. The x and y coordinates are
+    cell centers worked out from the geotransform of the first raster, rows
+    kept in their stored order. Nodata cells become missing values.
+    rasters = string (one multi-band raster) or list of raster files, all
+      on the same grid
+    outname = the full path and name of the output nc file
+    timeslice = the ndarray containing the temporal values, one per band
+    mem_limit = integer; bytes of raster data to read at once
+    kwargs = passed to create_nc (varname, units, calendar, chunks, ...).
+      The 'map' chunk preset suits this one-time-step-at-a-time writing.
+
+    output: a NETCDF4_CLASSIC file
+    """
+    if isinstance(rasters, str):
+        rasters = [rasters]
+    first = gdal.Open(rasters[0])
+    ncols, nrows = first.RasterXSize, first.RasterYSize
+    xcoords, ycoords = geo_coords(first.GetGeoTransform(), ncols, nrows)
+    first = None
+    out_ds, cvar = create_nc(timeslice, ycoords, xcoords, outname, **kwargs)
+    try:
+        tidx = 0
+        for ras_name in rasters:
+            ras_tif = gdal.Open(ras_name)
+            if (ras_tif.RasterXSize, ras_tif.RasterYSize) != (ncols, nrows):
+                raise ValueError(ras_name + ' is not on the same grid as ' + rasters[0])
+            for bnum in range(1, ras_tif.RasterCount + 1):
+                if tidx >= len(timeslice):
+                    raise ValueError('More bands than time values')
+                ras_band = ras_tif.GetRasterBand(bnum)
+                for y0, y1 in raster_windows(ras_band, mem_limit):
+                    cvar[tidx, y0:y1, :] = _read_window(ras_band, y0, y1)
+                tidx += 1
+            ras_tif = None
+        if tidx != len(timeslice):
+            raise ValueError('Found ' + str(tidx) + ' bands for ' +
+                             str(len(timeslice)) + ' time values')
+        out_ds.sync()
+    finally:
+        out_ds.close()
+    print('Created', outname)
+
 def nc2d_from_raster(ras_name, outname, **kwargs):
-    """Create a new 2-dimensional netCDF file from a geotiff raster
-    some code adapted from https://gis.stackexchange.com/questions/42790/
-    gdal-and-python-how-to-get-coordinates-for-all-cells-having-a-specific-value#42846
+    """Create a new 2-dimensional netCDF file from a geotiff raster,
+    copying it a window of rows at a time (see rasters2nc for stacks and
+    time series of rasters). Nodata cells become missing values.
     """
     argdic = {'varname':'var', 'xname':'longitude', 'yname':'latitude',
               'metadatastr':''}
@@ -212,24 +1691,20 @@ def nc2d_from_raster(ras_name, outname, **kwargs):
 
     ras_tif = gdal.Open(ras_name)
     ras_band = ras_tif.GetRasterBand(1)
-    ras_data = ras_band.ReadAsArray()
-    (upper_left_x, x_size, x_rotation, upper_left_y, y_rotation, y_size) = ras_tif.GetGeoTransform()
-    (y_index, x_index) = np.nonzero(ras_data)
-    x_coords = x_index * x_size + upper_left_x + (x_size / 2)
-    y_coords = y_index * y_size + upper_left_y + (y_size / 2)
-    x = ras_data.shape[1]
-    y = ras_data.shape[0]
-    x_slice = x_coords.reshape(y, x)
-    y_slice = y_coords.reshape(y, x)
+    x = ras_tif.RasterXSize
+    y = ras_tif.RasterYSize
+    x_coords, y_coords = geo_coords(ras_tif.GetGeoTransform(), x, y)
     out_ds = Dataset(outname, 'w', format='NETCDF4_CLASSIC')
     out_ds.createDimension(argdic['yname'], y)
     out_ds.createDimension(argdic['xname'], x)
     lat_var = out_ds.createVariable(argdic['yname'], 'f4', (argdic['yname'],))
     lon_var = out_ds.createVariable(argdic['xname'], 'f4', (argdic['xname'],))
     cvar = out_ds.createVariable(argdic['varname'], 'f4', (argdic['yname'], argdic['xname'],))
-    lon_var[:] = x_slice[0, :]
-    lat_var[:] = y_slice[:, 0]
-    cvar[:] = ras_data
+    lon_var[:] = x_coords
+    lat_var[:] = y_coords
+    for y0, y1 in raster_windows(ras_band):
+        cvar[y0:y1, :] = _read_window(ras_band, y0, y1)
+    ras_tif = None
     ds_att = {u'description': argdic['metadatastr'],
               u'history': 'Created ' + time.ctime(time.time())}
     out_ds.setncatts(ds_att)
@@ -22,14 +22,36 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see https://www.gnu.org/licenses/
 """
 
+import re
 import numpy as np
-from netCDF4 import date2num
+import cftime
+import nc_func_py3 as nc_func
 
 SEASONS_LU = {1:1, 2:1, 12:1, 3:2, 4:2, 5:2, 6:3, 7:3, 8:3, 9:4, 10:4, 11:4}
 TWOSEASONS_LU = {1:5, 2:5, 12:5, 3:5, 4:5, 5:5, 6:6, 7:6, 8:6, 9:6, 10:6, 11:6}
 WATERYR_LU = {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, 7:0, 8:0, 9:0, 10:-1, 11:-1, 12:-1}
 ANN_LU = {1:0, 2:0, 12:0, 3:0, 4:0, 5:0, 6:0, 7:0, 8:0, 9:0, 10:0, 11:0}
 
+ALL_SEASONS = (0, 1, 2, 3, 4, 5, 6)
+
+_WATERYR = np.array([0] + [WATERYR_LU[m] for m in range(1, 13)], dtype=np.int64)
+_SEASONS = np.array([-1] + [SEASONS_LU[m] for m in range(1, 13)], dtype=np.int64)
+_TWOSEASONS = np.array([-1] + [TWOSEASONS_LU[m] for m in range(1, 13)], dtype=np.int64)
+_UNITS_RE = re.compile(r'\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+                       r'(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?')
+_UNIT_SECONDS = {'days': 86400.0, 'day': 86400.0, 'd': 86400.0,
+                 'hours': 3600.0, 'hour': 3600.0, 'h': 3600.0,
+                 'minutes': 60.0, 'minute': 60.0, 'seconds': 1.0, 'second': 1.0,
+                 's': 1.0}
+_STANDARD_CAL = ('gregorian', 'standard', 'proleptic_gregorian')
+#Cumulative days at the start of each month (plus year length) for calendars
+#where every year has the same length
+_FIXED_CAL = {'noleap': np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+              'all_leap': np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+              '360_day': np.arange(0, 361, 30)}
+_FIXED_CAL['365_day'] = _FIXED_CAL['noleap']
+_FIXED_CAL['366_day'] = _FIXED_CAL['all_leap']
+
 def clean_name(inmodel, inseason, invar):
     """Create a clean naming prefix for output files
     inputs:
@@ -61,37 +83,257 @@ def clean_name(inmodel, inseason, invar):
     namestr = "_".join([modname, when, invar])
     return namestr
 
+def season_lookup(season):
+    """Return the month -> season lookup table used for a season number, as
+    an integer array indexed by month (element 0 is unused).
+    season = integer; 0 (annual), 1-4 (SEASONS_LU) or 5-6 (TWOSEASONS_LU)
+    """
+    if season == 0:
+        table = ANN_LU
+    elif 0 < season < 5:
+        table = SEASONS_LU
+    elif season in (5, 6):
+        table = TWOSEASONS_LU
+    else:
+        raise ValueError('Unknown season ' + str(season))
+    lut = np.full(13, -1, dtype=np.int64)
+    for mth, val in table.items():
+        lut[mth] = val
+    return lut
+
+def _parse_units(units):
+    """Split CF time units such as 'days since 1950-01-01 00:00:00' into
+    (seconds per unit, base year, month, day, fraction of base day).
+    Returns None if the units string is not in a form handled here.
+    """
+    match = _UNITS_RE.match(units)
+    if match is None or match.group(1).lower() not in _UNIT_SECONDS:
+        return None
+    grp = match.groups()
+    hrs, mins, secs = [float(g) if g else 0.0 for g in grp[4:7]]
+    frac = (hrs * 3600.0 + mins * 60.0 + secs) / 86400.0
+    return (_UNIT_SECONDS[grp[0].lower()], int(grp[1]), int(grp[2]),
+            int(grp[3]), frac)
+
+def decode_yrmon(times, units='days since 1950-01-01 00:00:00',
+                 calendar='gregorian'):
+    """Get the year and month of every value on a numeric netCDF time axis
+    without building a list of date objects.
+    times = array of numeric time values (e.g. netCDF time variable[:])
+    units = string; CF time units of times
+    calendar = string; CF calendar, including the 'noleap'/'365_day',
+      'all_leap'/'366_day' and '360_day' calendars used by many GCMs.
+
+    output: two integer ndarrays, (years, months)
+    """
+    times = np.asarray(np.ma.getdata(times), dtype=np.float64)
+    calendar = calendar.lower()
+    parsed = _parse_units(units)
+    if parsed is not None:
+        unitsec, byr, bmth, bday, frac = parsed
+        days = np.floor(times * (unitsec / 86400.0) + frac).astype(np.int64)
+        if calendar in _STANDARD_CAL and (byr, bmth, bday) >= (1582, 10, 15):
+            base = np.datetime64('%04d-%02d-%02d' % (byr, bmth, bday), 'D')
+            dates = base + days
+            years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+            months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+            return years, months
+        if calendar in _FIXED_CAL:
+            cumdays = _FIXED_CAL[calendar]
+            yrlen = cumdays[-1]
+            absday = byr * yrlen + cumdays[bmth - 1] + bday - 1 + days
+            years = absday // yrlen
+            months = np.searchsorted(cumdays, absday % yrlen, side='right')
+            return years, months
+    dates = cftime.num2date(times, units, calendar)
+    years = np.fromiter((a_date.year for a_date in dates), np.int64, times.size)
+    months = np.fromiter((a_date.month for a_date in dates), np.int64, times.size)
+    return years, months
+
+def wateryear_labels(years, months, yrlist, season):
+    """Label each time step with the water year it belongs to within a season.
+    The label is the position of the water year in yrlist, so labels can be
+    used directly with nc_func.group_reduce. October through December count
+    towards the following water year (see WATERYR_LU).
+    years = integer ndarray; calendar year of each time step
+    months = integer ndarray; month of each time step
+    yrlist = list; the range of four-digit years of interest
+    season = integer; taken from SEASONS_LU dictionary
+
+    output: integer ndarray, -1 where the time step is not part of the season
+      or falls outside yrlist.
+    """
+    years = np.asarray(years)
+    months = np.asarray(months)
+    watyr = years - _WATERYR[months]
+    yrarr = np.asarray(list(yrlist), dtype=np.int64)
+    order = np.argsort(yrarr)
+    pos = np.clip(np.searchsorted(yrarr, watyr, sorter=order), 0, yrarr.size - 1)
+    idx = order[pos]
+    inyrs = yrarr[idx] == watyr
+    labels = np.where(inyrs & (season_lookup(season)[months] == season), idx, -1)
+    return labels
+
+def watyrlabels(times, yrlist, season, units='days since 1950-01-01 00:00:00',
+                calendar='gregorian'):
+    """Water-year/season group labels straight from a numeric time axis.
+    times = array of numeric time values (e.g. netCDF time variable[:])
+    yrlist = list; the range of four-digit years of interest
+    season = integer; taken from SEASONS_LU dictionary
+    units, calendar = strings; CF time units and calendar of times
+
+    output: integer ndarray of group labels (see wateryear_labels)
+    """
+    years, months = decode_yrmon(times, units, calendar)
+    return wateryear_labels(years, months, yrlist, season)
+
 def watyrmask(orig_dates, datelist, yrlist, season, **kwargs):
     """Alter the seasonal masks to follow a 'water year' instead of a calendar year
     inputs:
     orig_dates = ndarray; the original time values of the netCDF converted to dates
-    datelist = list; the original time values of the netCDF flattened to a list
+    datelist = list; the original time values of the netCDF flattened to a list.
+      No longer used, kept so existing calls still work.
     yrlist = list; the range of four-digit years of interest
     season = integer; taken from SEASONS_LU dictionary
-    kwargs = dictionary; additional variables defining time units and calendar
-      defaults: {'units':'days since 1950-01-01 00:00:00', 'calen':'gregorian'}
+    kwargs = dictionary; no longer used, kept so existing calls still work.
 
     output: a new set of masks
+
+    For new code, watyrlabels works directly from the numeric time axis and
+    avoids building date objects altogether.
     """
-    if kwargs == {}:
-        kwargs = {'units':'days since 1950-01-01 00:00:00', 'calen':'gregorian'}
-    yrs = np.array([a_date.year for a_date in orig_dates], dtype=np.int)
-    mths = np.array([a_date.month for a_date in orig_dates], dtype=np.int)
-    if season == 0:
-        seasons = np.array([ANN_LU[m] for m in mths], dtype=np.int)
-    elif season > 0 & season < 5:
-        seasons = np.array([SEASONS_LU[m] for m in mths], dtype=np.int)
-    elif season == 5 | season == 6:
-        seasons = np.array([TWOSEASONS_LU[m] for m in mths], dtype=np.int)
-    omasks = []
-    for a_yr in yrlist:
-        omasks.append(np.ma.where(np.ma.logical_and(yrs == a_yr,
-                                                    seasons == season))[0])
-    water_dates = np.array(
-        [a_date.replace(
-            year=a_date.year + WATERYR_LU[a_date.month]) for a_date in orig_dates])
-    water_slice = date2num(water_dates, kwargs['units'], kwargs['calen'])
-    newmasks = []
-    for z in omasks:
-        newmasks.append([datelist.index(water_slice[a]) for a in z])
-    return newmasks
+    count = len(orig_dates)
+    yrs = np.fromiter((a_date.year for a_date in orig_dates), np.int64, count)
+    mths = np.fromiter((a_date.month for a_date in orig_dates), np.int64, count)
+    labels = wateryear_labels(yrs, mths, yrlist, season)
+    return [np.flatnonzero(labels == i) for i in range(len(yrlist))]
+
+def season_labels(months, seasons=ALL_SEASONS):
+    """Group labels for every season scheme at once: annual, the four seasons
+    of SEASONS_LU and the two seasons of TWOSEASONS_LU. The label of a time
+    step in each scheme is its season number, so the result can be passed
+    straight to nc_func.GroupAccumulator.update.
+    months = integer ndarray; month of each time step
+    seasons = iterable of season numbers to keep, others are labelled -1
+
+    output: integer ndarray [3, time]
+    """
+    months = np.asarray(months)
+    labels = np.vstack([np.zeros_like(months), _SEASONS[months],
+                        _TWOSEASONS[months]])
+    labels[~np.isin(labels, list(seasons))] = -1
+    return labels
+
+def multiseason_stats(data, times, windows, method, units='days since 1950-01-01 00:00:00',
+                      calendar='gregorian', seasons=ALL_SEASONS,
+                      mem_limit=nc_func.MEM_LIMIT):
+    """Water-year seasonal means for several year windows and every season
+    scheme, from a single pass over the time axis of data.
+
+    Each water year is reduced into annual, seasonal and two-season values
+    together (method 'sum' or 'mean' over the time steps of the season),
+    which are then averaged across the water years of every window that
+    contains that year.
+    data = [time, y, x] ndarray, masked array or netCDF variable. The data is
+      streamed with nc_func.iter_blocks as NaN-filled float32 blocks, so a
+      netCDF variable never has more than about mem_limit bytes read into
+      memory at once.
+    times = array of numeric time values for data, in increasing order
+    windows = dictionary; window name -> list of four-digit water years, e.g.
+      {'hist': range(1971, 1999), 'fut': range(2037, 2065)}
+    method = string; 'sum' or 'mean'
+    units, calendar = strings; CF time units and calendar of times
+    seasons = iterable of season numbers (see clean_name)
+    mem_limit = integer; bytes of data to read at once
+
+    output: dictionary; season -> {window name: masked array [y, x]} of
+      nc_func.FLOAT_DTYPE
+    """
+    years, months = decode_yrmon(times, units, calendar)
+    watyr = years - _WATERYR[months]
+    if np.any(np.diff(watyr) < 0):
+        raise ValueError('The time axis must be in increasing order')
+    seasons = list(seasons)
+    labels = season_labels(months, seasons)
+    shape = tuple(data.shape[1:])
+    nseas = len(ALL_SEASONS)
+    windows = dict((name, set(yrs)) for name, yrs in windows.items())
+    totals = dict((name, np.zeros((nseas,) + shape, dtype=nc_func.ACCUM_DTYPE))
+                  for name in windows)
+    counts = dict((name, np.zeros((nseas,) + shape, dtype=np.int32))
+                  for name in windows)
+    state = {'acc': None, 'yr': None, 'rows': None}
+
+    def close_year():
+        """Fold the finished water year into its windows"""
+        acc = state['acc']
+        if acc is not None:
+            yrvals = acc.result(method, nan=True)
+            valid = ~np.isnan(yrvals)
+            yrvals[~valid] = 0
+            for name, yrs in windows.items():
+                if state['yr'] in yrs:
+                    totals[name][:, state['rows']] += yrvals
+                    counts[name][:, state['rows']] += valid
+        state['acc'] = None
+        state['yr'] = None
+
+    if isinstance(data, np.ndarray):
+        blocks = [(slice(None), slice(None), data)]
+    else:
+        blocks = nc_func.iter_blocks(data, mem_limit, nan=True)
+    for tslice, rows, block in blocks:
+        if rows != state['rows']:
+            close_year()
+            state['rows'] = rows
+        blkyrs = watyr[tslice]
+        blklabels = labels[:, tslice]
+        for start, stop, a_yr in zip(*nc_func.label_runs(blkyrs)):
+            if a_yr != state['yr']:
+                close_year()
+                state['yr'] = a_yr
+                if any(a_yr in yrs for yrs in windows.values()):
+                    state['acc'] = nc_func.GroupAccumulator(
+                        nseas, block.shape[1:], (method,))
+            if state['acc'] is not None:
+                state['acc'].update(block[start:stop], blklabels[:, start:stop])
+    close_year()
+    out = {}
+    for s in seasons:
+        out[s] = {}
+        for name in windows:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = totals[name][s] / counts[name][s]
+            out[s][name] = np.ma.array(mean.astype(nc_func.FLOAT_DTYPE),
+                                       mask=counts[name][s] == 0)
+    return out
+
+def pct_change(hist, fut):
+    """Percent change from hist to fut, avoiding divide by zero"""
+    hist_x = np.ma.where(hist == 0, 0.01, hist)
+    return np.ma.multiply(np.ma.divide(np.ma.subtract(fut, hist), hist_x), 100)
+
+def season_products(data, times, hist_yrs, fut_yrs, method, change='pct',
+                    units='days since 1950-01-01 00:00:00', calendar='gregorian',
+                    seasons=ALL_SEASONS, mem_limit=nc_func.MEM_LIMIT):
+    """Historical and future seasonal means plus their change for every season,
+    computed in one traversal of data (see multiseason_stats).
+    hist_yrs, fut_yrs = lists; four-digit water years of each window
+    method = string; 'sum' or 'mean' within each water-year season
+    change = string; 'pct' for percent change or 'delta' for the difference
+    mem_limit = integer; bytes of data to read at once
+
+    output: dictionary; season -> (historical, future, change) masked arrays
+    """
+    stats = multiseason_stats(data, times, {'hist': hist_yrs, 'fut': fut_yrs},
+                              method, units, calendar, seasons, mem_limit)
+    out = {}
+    for s, windows in stats.items():
+        hist = windows['hist']
+        fut = windows['fut']
+        if change == 'pct':
+            chg = pct_change(hist, fut)
+        else:
+            chg = np.ma.subtract(fut, hist)
+        out[s] = (hist, fut, chg)
+    return out
@@ -22,76 +22,488 @@ along with this program.  If not, see https://www.gnu.org/licenses/
 """
 
 import os
-import pysal
+import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+import shapely
+from pyproj import CRS
+from scipy.spatial import cKDTree
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+#OGR formats go through Arrow only when both are installed
+OGR_ARROW = pa is not None and pyogrio is not None
 
-def filter_duplicates(infile, idfield, rankfield, otherfld=None, epsg=None):
+def _need_pyarrow(filename):
+    '''Raises an ImportError for Parquet files when pyarrow is missing'''
+    if pq is None:
+        raise ImportError('Reading or writing ' + filename + ' needs pyarrow')
+
+def iter_points(infile, columns=None, batch_size=65536, xfield='x', yfield='y'):
+    '''Reads a point file in batches of at most batch_size records, as
+    columnar numpy arrays rather than rows of geometry objects. GeoPackages,
+    shapefiles and other OGR formats are read through pyogrio and Arrow when
+    they are installed (otherwise through geopandas), Parquet through
+    pyarrow and CSV through pandas. Yields tuples (x, y, attrs), attrs being
+    a dictionary of fieldname: numpy array.
+
+    infile: (string) path, filename, and extension of input point file
+    columns: (list of strings, optional) attribute fields to read, all by default
+    batch_size: (integer) maximum number of records per batch
+    xfield, yfield: (strings) coordinate fields of a CSV file, or of a
+        Parquet file that is not GeoParquet and has no WKB 'geometry' field
+    '''
+    ext = os.path.splitext(infile)[1].lower()
+    if ext == '.csv':
+        usecols = None if columns is None else [xfield, yfield] + list(columns)
+        for chunk in pd.read_csv(infile, usecols=usecols, chunksize=batch_size):
+            attrs = dict((fld, chunk[fld].values) for fld in chunk.columns
+                         if fld not in (xfield, yfield))
+            yield chunk[xfield].values, chunk[yfield].values, attrs
+    elif ext == '.parquet':
+        _need_pyarrow(infile)
+        pfile = pq.ParquetFile(infile)
+        names = pfile.schema_arrow.names
+        geo = _geoparquet(infile)
+        if geo is not None:
+            geom = geo['primary_column']
+        else:
+            geom = 'geometry' if 'geometry' in names else None
+        coords = [geom] if geom else [xfield, yfield]
+        if columns is None:
+            columns = [fld for fld in names if fld not in coords]
+        for batch in pfile.iter_batches(batch_size, columns=coords + list(columns)):
+            yield _arrow_points(batch, geom, xfield, yfield, columns)
+    elif OGR_ARROW:
+        with pyogrio.open_arrow(infile, columns=columns, batch_size=batch_size,
+                                use_pyarrow=True) as (meta, reader):
+            geom = meta['geometry_name'] or 'wkb_geometry'
+            fields = list(meta['fields'])
+            for batch in reader:
+                yield _arrow_points(batch, geom, xfield, yfield, fields)
+    else:
+        geodf = gpd.read_file(infile, columns=columns)
+        fields = [fld for fld in geodf.columns if fld != geodf.geometry.name]
+        for start in range(0, len(geodf), batch_size):
+            part = geodf.iloc[start:start + batch_size]
+            yield (part.geometry.x.values, part.geometry.y.values,
+                   dict((fld, part[fld].values) for fld in fields))
+
+def _arrow_points(batch, geom, xfield, yfield, fields):
+    '''Coordinates and attribute arrays of an Arrow record batch'''
+    if geom is not None:
+        points = shapely.from_wkb(batch.column(geom).to_numpy(zero_copy_only=False))
+        x = shapely.get_x(points)
+        y = shapely.get_y(points)
+    else:
+        x = batch.column(xfield).to_numpy(zero_copy_only=False)
+        y = batch.column(yfield).to_numpy(zero_copy_only=False)
+    attrs = dict((fld, batch.column(fld).to_numpy(zero_copy_only=False))
+                 for fld in fields)
+    return x, y, attrs
+
+def _geoparquet(infile):
+    '''GeoParquet 'geo' metadata of a Parquet file as a dictionary, or None'''
+    meta = pq.read_schema(infile).metadata or {}
+    if b'geo' not in meta:
+        return None
+    return json.loads(meta[b'geo'])
+
+def _geo_metadata(crs):
+    '''GeoParquet 'geo' metadata for a WKB point column called geometry'''
+    projjson = CRS.from_user_input(crs).to_json_dict() if crs is not None else None
+    return {'version': '1.0.0', 'primary_column': 'geometry',
+            'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'],
+                                     'crs': projjson}}}
+
+def point_crs(infile):
+    '''Returns the coordinate system of a point file as a string, or None
+    (always None for CSV and for Parquet files that are not GeoParquet).
+    '''
+    ext = os.path.splitext(infile)[1].lower()
+    if ext == '.csv':
+        return None
+    if ext == '.parquet':
+        _need_pyarrow(infile)
+        geo = _geoparquet(infile)
+        if geo is None:
+            return None
+        column = geo['columns'][geo['primary_column']]
+        if 'crs' not in column:
+            #GeoParquet's default when the crs is left out
+            return 'OGC:CRS84'
+        if column['crs'] is None:
+            return None
+        return CRS.from_json_dict(column['crs']).to_string()
+    if pyogrio is not None:
+        return pyogrio.read_info(infile)['crs']
+    crs = gpd.read_file(infile, rows=1).crs
+    return crs.to_string() if crs is not None else None
+
+def read_points(infile, columns=None, batch_size=65536, xfield='x', yfield='y'):
+    '''Reads a whole point file as columnar numpy arrays (see iter_points).
+    Output is a tuple (x, y, attrs, crs).
+    '''
+    xs, ys, parts = [], [], []
+    for x, y, attrs in iter_points(infile, columns, batch_size, xfield, yfield):
+        xs.append(x)
+        ys.append(y)
+        parts.append(attrs)
+    fields = list(parts[0]) if parts else []
+    attrs = dict((fld, np.concatenate([part[fld] for part in parts])) for fld in fields)
+    x = np.concatenate(xs) if xs else np.zeros(0)
+    y = np.concatenate(ys) if ys else np.zeros(0)
+    return x, y, attrs, point_crs(infile)
+
+def write_points(outfile, x, y, attrs, crs=None, append=False, xfield='x',
+                 yfield='y'):
+    '''Writes points from columnar numpy arrays, the counterpart of
+    iter_points: through pyogrio and Arrow for GeoPackages, shapefiles and
+    other OGR formats (geopandas if they are not installed), pyarrow for
+    GeoParquet (WKB geometry, with the crs in its 'geo' metadata) and pandas
+    for CSV (x and y fields, no crs). Call repeatedly with append=True to
+    write a large output in batches (not possible for Parquet).
+
+    outfile: (string) path, filename, and extension of the output file
+    x, y: (numpy arrays) point coordinates
+    attrs: (dictionary) fieldname: numpy array of attribute values
+    crs: (string, optional) coordinate system, e.g. 'EPSG:6350'
+    append: (boolean) add to an existing file
+    xfield, yfield: (strings) coordinate field names for CSV
+    '''
+    ext = os.path.splitext(outfile)[1].lower()
+    if ext == '.csv':
+        if crs is not None:
+            print('NOTE: CSV files have no coordinate system,', crs, 'is not written to',
+                  outfile)
+        table = pd.DataFrame(dict([(xfield, x), (yfield, y)] + list(attrs.items())))
+        table.to_csv(outfile, mode='a' if append else 'w', header=not append,
+                     index=False)
+    elif ext == '.parquet':
+        _need_pyarrow(outfile)
+        if append:
+            raise ValueError('Cannot append to a Parquet file')
+        wkb = shapely.to_wkb(shapely.points(x, y))
+        table = pa.table(dict(list(attrs.items()) + [('geometry', pa.array(wkb))]))
+        table = table.replace_schema_metadata({'geo': json.dumps(_geo_metadata(crs))})
+        pq.write_table(table, outfile)
+    elif OGR_ARROW:
+        wkb = shapely.to_wkb(shapely.points(x, y))
+        table = pa.table(dict(list(attrs.items()) + [('geometry', pa.array(wkb))]))
+        pyogrio.write_arrow(table, outfile, geometry_name='geometry',
+                            geometry_type='Point', crs=crs, append=append)
+    else:
+        points_frame(x, y, attrs, crs).to_file(outfile, mode='a' if append else 'w')
+    print('Wrote', len(x), 'points to', outfile)
+
+def points_frame(x, y, attrs, crs=None, index=None):
+    '''Builds a geopandas dataframe of points from columnar numpy arrays.
+
+    index: (array, optional) row labels, e.g. the positions of the points
+        in the input file
+    '''
+    return gpd.GeoDataFrame(attrs, geometry=gpd.points_from_xy(x, y), crs=crs,
+                            index=index)
+
+def kept_frame(x, y, attrs, crs, keep):
+    '''Geopandas dataframe of the points selected by the boolean array keep,
+    indexed by their positions in the input.
+    '''
+    attrs = dict((fld, ary[keep]) for fld, ary in attrs.items())
+    return points_frame(x[keep], y[keep], attrs, crs, np.flatnonzero(keep))
+
+def write_frame(outfile, geodf, append=False):
+    '''Writes a geopandas point dataframe with write_points. A named index
+    (e.g. the 'xy' of filter_duplicates) is written as a field.
+    '''
+    if geodf.index.name is not None:
+        geodf = geodf.reset_index()
+    crs = geodf.crs.to_string() if geodf.crs is not None else None
+    attrs = dict((fld, geodf[fld].values) for fld in geodf.columns
+                 if fld != geodf.geometry.name)
+    write_points(outfile, geodf.geometry.x.values, geodf.geometry.y.values,
+                 attrs, crs, append)
+
+def duplicate_groups(x, y, tolerance=None):
+    '''Groups points at the same location by hashing their raw coordinates,
+    or their coordinates snapped to a grid of the given tolerance. Output is
+    a numpy integer array with the group number of each point, groups
+    numbered in order of first appearance.
+
+    x, y: (numpy arrays) point coordinates
+    tolerance: (number, optional) points snapped to the same multiple of
+        tolerance in both x and y are duplicates. Exact matches by default.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if tolerance is None:
+        #Adding 0.0 turns -0.0 into 0.0, so the bit patterns compare as values
+        kx = (x + 0.0).view(np.int64)
+        ky = (y + 0.0).view(np.int64)
+    else:
+        kx = np.floor(x / tolerance + 0.5).astype(np.int64)
+        ky = np.floor(y / tolerance + 0.5).astype(np.int64)
+    keys = pd.DataFrame({'kx': kx, 'ky': ky})
+    return keys.groupby(['kx', 'ky'], sort=False).ngroup().values
+
+def filter_duplicates(infile, idfield, rankfield, otherfld=None, epsg=None,
+                      tolerance=None):
     '''Removes spatial duplicates and returns unique shapes with the maximum
-    value of specified rankfield. Output is a geopandas dataframe.
+    value of specified rankfield. Output is a geopandas dataframe, indexed by
+    the WKT of each location ('xy') in sorted order.
 
-    infile: (string) path, filename, and extension of input geodata file (e.g., shapefile)
-    idfield: (string) fieldname that uniquely identifies each record
+    infile: (string) path, filename, and extension of input point geodata file (e.g., shapefile)
+    idfield: (string) fieldname that uniquely identifies each record; the
+        minimum among the duplicates is retained.
     rankfield: (string) fieldname of a numeric ranking field
     otherfld: (string, optional) a third field to save in the output, only the
         first encountered value among the duplicates is retained.
     epsg: (string, optional) in the form 'epsg:<number>' representing coordinate
         projection of the geodata.
+    tolerance: (number, optional) treat points within this distance (on a
+        grid of this size) as duplicates, see duplicate_groups. The first
+        encountered location of each group is kept.
     '''
-    geodf = gpd.read_file(infile)
-    if epsg is not None:
-        geodf.crs = {'init': epsg}
-    geodf['xy'] = geodf['geometry'].apply(lambda x: str(x))
     if otherfld is None:
-        fldlist = [idfield, 'xy', rankfield, otherfld, 'geometry']
-        flddict = {idfield: 'min', rankfield: 'max', otherfld: 'first'}
-    else:
-        fldlist = [idfield, 'xy', rankfield, 'geometry']
         flddict = {idfield: 'min', rankfield: 'max'}
-    geodf = geodf[fldlist]
-    nodups = geodf.dissolve(by='xy', aggfunc=flddict)
+    else:
+        flddict = {idfield: 'min', rankfield: 'max', otherfld: 'first'}
+    x, y, attrs, crs = read_points(infile, list(flddict))
+    if epsg is not None:
+        crs = epsg
+    groups = duplicate_groups(x, y, tolerance)
+    nodups = pd.DataFrame(attrs).groupby(groups, sort=True).agg(flddict)
+    _, first = np.unique(groups, return_index=True)
+    nodups = points_frame(x[first], y[first], nodups, crs)
+    nodups.index = pd.Index(nodups.geometry.to_wkt(rounding_precision=-1).values,
+                            name='xy')
+    nodups = nodups[['geometry'] + list(flddict)].sort_index()
     return nodups
 
+def thin_points(xy, ranks, dist, tree=None, reuse=None):
+    '''Greedy rank thinning: visits the points from the highest to the lowest
+    rank (ties in input order), keeping each point not yet suppressed and
+    suppressing every other point within dist of it. The neighbors are
+    found with a KD-tree, so the cost grows with the number of points kept
+    rather than with the number of point pairs. Output is a boolean numpy
+    array, True for the points kept.
+
+    xy: (numpy array) point coordinates, shape (n, 2), in projection units
+    ranks: (numpy array) numeric rank of each point, higher is better
+    dist: (number, float or integer) minimum distance, in projection units
+    tree: (scipy cKDTree, optional) tree already built on xy
+    reuse: (dictionary, optional) neighbor queries shared between calls at
+        different distances, largest distance first: the neighbors found
+        for a point are stored in it, and later calls at a smaller distance
+        filter the stored ones instead of querying the tree again.
+    '''
+    xy = np.asarray(xy, dtype=np.float64)
+    if tree is None:
+        tree = cKDTree(xy)
+    order = np.argsort(-np.asarray(ranks, dtype=np.float64), kind='stable')
+    suppressed = np.zeros(len(xy), dtype=bool)
+    keep = np.zeros(len(xy), dtype=bool)
+    for idx in order:
+        if suppressed[idx]:
+            continue
+        keep[idx] = True
+        if reuse is None:
+            suppressed[tree.query_ball_point(xy[idx], dist, return_sorted=False)] = True
+            continue
+        if idx not in reuse or reuse[idx][0] < dist:
+            near = np.asarray(tree.query_ball_point(xy[idx], dist, return_sorted=False),
+                              dtype=np.intp)
+            reuse[idx] = (dist, near, np.hypot(*(xy[near] - xy[idx]).T))
+        _, near, ndist = reuse[idx]
+        suppressed[near[ndist <= dist]] = True
+    return keep
+
 def filter_by_distance_rank(infile, dist, rankfield):
-    '''Thins out a point geodataset so that the selected points represent
-    the maximum rankfield value of all points within the specified distance.
-    Output is a geopandas dataframe.
+    '''Thins out a point geodataset so that no two selected points are within
+    the specified distance, preferring points with the higher rankfield
+    value (see thin_points). Output is a geopandas dataframe.
 
     infile: (string) path, filename, and extension of input geodata file (e.g., shapefile)
     dist: (number, float or integer) minimum distance, in projection units
     rankfield: (string) fieldname of a numeric ranking field
     '''
-    indf = pysal.pdio.read_files(infile)
-    wdist = pysal.weights.DistanceBand.from_dataframe(indf, dist, silent=True)
-    wdw = wdist.weights
-    wdn = wdist.neighbors
-
-    for fid in wdist:
-        nwpairs = [(k, indf[rankfield][k]) for k in fid[1].iterkeys()]
-        newdic = dict(nwpairs)
-        wdw.update({fid[0]:newdic.values()})
-        wdn.update({fid[0]:newdic.keys()})
-
-    wnew = pysal.W(wdn, wdw, silent_island_warning=True)
-    keeplst = []
-    procd = []
-
-    for nwfid in wnew:
-        idx = nwfid[0]
-        if len(nwfid[1].keys()) > 0:
-            fdict = nwfid[1]
-            iwght = indf[rankfield][idx]
-            fdict.update({idx:iwght})
-            winner = fdict.keys()[fdict.values().index(max(fdict.values()))]
-            if winner not in procd:
-                keeplst.append(winner)
-                procd = procd + wdn[winner]
-                procd.append(winner)
-        else:
-            keeplst.append(idx)
-            procd.append(idx)
+    x, y, attrs, crs = read_points(infile)
+    keep = thin_points(np.column_stack((x, y)), attrs[rankfield], dist)
+    return kept_frame(x, y, attrs, crs, keep)
+
+def file_key(infile, crs=None):
+    '''Returns a key identifying the contents of a file and a coordinate
+    system: a sha1 hex digest of the file's bytes and the CRS string.
+
+    infile: (string) path, filename, and extension of a file
+    crs: (string, optional) coordinate system description, e.g. 'EPSG:6350'
+    '''
+    sha = hashlib.sha1()
+    with open(infile, 'rb') as src:
+        for block in iter(lambda: src.read(1024 * 1024), b''):
+            sha.update(block)
+    sha.update(str(crs).encode('utf-8'))
+    return sha.hexdigest()
+
+def point_index(xy, cache_dir=None, key=None):
+    '''Builds the KD-tree (scipy cKDTree) used to find neighboring points.
+
+    xy: (numpy array) point coordinates, shape (n, 2), in projection units
+    cache_dir: (string, optional) folder to keep the tree in between runs.
+        A tree stored there under the same key is loaded instead of built.
+    key: (string, optional) identifies the points, see file_key. Required
+        with cache_dir.
+    '''
+    cache = None
+    if cache_dir is not None:
+        cache = os.path.join(cache_dir, 'kdtree_' + key + '.pkl')
+        if os.path.isfile(cache):
+            with open(cache, 'rb') as src:
+                return pickle.load(src)
+    tree = cKDTree(np.asarray(xy, dtype=np.float64))
+    if cache is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache, 'wb') as dst:
+            pickle.dump(tree, dst, protocol=pickle.HIGHEST_PROTOCOL)
+    return tree
+
+def filter_by_distances(infile, dists, rankfield, cache_dir=None):
+    '''Thins a point geodataset at several distances in one call (see
+    filter_by_distance_rank), to help choose a thinning distance. The points
+    are read and the KD-tree built once; with cache_dir the tree is also
+    kept on disk, keyed by the file's contents and CRS, for later runs.
+    Distances are run from the largest down, and the neighbors found for a
+    point are reused, filtered, at the smaller distances.
+    Output is a tuple: (dictionary of distance: geopandas dataframe of the
+    points kept, pandas dataframe of the number of points retained per distance)
+
+    infile: (string) path, filename, and extension of input geodata file (e.g., shapefile)
+    dists: (list of numbers) distances to try, in projection units
+    rankfield: (string) fieldname of a numeric ranking field
+    cache_dir: (string, optional) folder for the persisted KD-tree
+    '''
+    x, y, attrs, crs = read_points(infile)
+    xy = np.column_stack((x, y))
+    key = None
+    if cache_dir is not None:
+        key = file_key(infile, crs)
+    tree = point_index(xy, cache_dir, key)
+    ranks = attrs[rankfield]
+    reuse = {}
+    thinned = {}
+    for dist in sorted(dists, reverse=True):
+        keep = thin_points(xy, ranks, dist, tree, reuse)
+        thinned[dist] = kept_frame(x, y, attrs, crs, keep)
+    counts = pd.DataFrame({'distance': sorted(dists),
+                           'retained': [len(thinned[d]) for d in sorted(dists)]})
+    print(counts.to_string(index=False))
+    return thinned, counts
+
+def raster_grid(ras_name):
+    '''Returns the geotransform (origin x, pixel width, 0, origin y, 0,
+    pixel height) of a reference raster, e.g. a climate grid, to thin
+    points onto its cells. Needs GDAL.
+
+    ras_name: (string) path, filename, and extension of the raster
+    '''
+    from osgeo import gdal
+    ras = gdal.Open(ras_name)
+    geotransform = ras.GetGeoTransform()
+    ras = None
+    return geotransform
+
+def grid_cells(x, y, geotransform):
+    '''Returns the column and row (numpy int64 arrays) of the grid cell that
+    each point falls in.
+
+    x, y: (numpy arrays) point coordinates
+    geotransform: (tuple) grid origin and cell size, as from raster_grid
+    '''
+    origin_x, pwidth, _, origin_y, _, pheight = geotransform
+    cols = np.floor((np.asarray(x, dtype=np.float64) - origin_x) / pwidth)
+    rows = np.floor((np.asarray(y, dtype=np.float64) - origin_y) / pheight)
+    return cols.astype(np.int64), rows.astype(np.int64)
+
+def _top_per_cell(cols, rows, ranks):
+    '''Positions of the highest ranked point (first in input order among
+    ties) in every cell. Run on the worker processes of thin_grid.
+    '''
+    order = np.lexsort((np.arange(len(ranks)), -ranks, rows, cols))
+    cols = cols[order]
+    rows = rows[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (cols[1:] != cols[:-1]) | (rows[1:] != rows[:-1])
+    return order[first]
 
-    keeplst = list(set(keeplst))
-    return indf.iloc[keeplst]
+def thin_grid(x, y, ranks, geotransform, tile_cells=1024, workers=1):
+    '''Grid thinning: keeps the highest ranked point in every grid cell
+    (one point per environmental cell). The grid is cut into square tiles of
+    cells, and since no cell spans two tiles, the tiles are thinned
+    independently, on a pool of worker processes if workers > 1. Output is a
+    boolean numpy array, True for the points kept.
+
+    x, y: (numpy arrays) point coordinates
+    ranks: (numpy array) numeric rank of each point, higher is better
+    geotransform: (tuple) grid origin and cell size, as from raster_grid,
+        or (0, cellsize, 0, 0, 0, cellsize) for square cells of a given size
+    tile_cells: (integer) width and height of a tile, in cells
+    workers: (integer) number of worker processes. With more than 1, call
+        from inside an 'if __name__ == "__main__":' block.
+    '''
+    ranks = np.asarray(ranks, dtype=np.float64)
+    cols, rows = grid_cells(x, y, geotransform)
+    tiles = pd.DataFrame({'tx': cols // tile_cells, 'ty': rows // tile_cells})
+    tiles = tiles.groupby(['tx', 'ty'], sort=False).ngroup().values
+    order = np.argsort(tiles, kind='stable')
+    bounds = np.flatnonzero(np.diff(tiles[order])) + 1
+    jobs = np.split(order, bounds)
+    keep = np.zeros(len(ranks), dtype=bool)
+    if workers == 1:
+        for idx in jobs:
+            keep[idx[_top_per_cell(cols[idx], rows[idx], ranks[idx])]] = True
+        return keep
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(idx, pool.submit(_top_per_cell, cols[idx], rows[idx], ranks[idx]))
+                   for idx in jobs]
+        for idx, fut in futures:
+            keep[idx[fut.result()]] = True
+    return keep
+
+def filter_by_grid(infile, rankfield, cellsize=None, reference=None,
+                   tile_cells=1024, workers=1):
+    '''Thins out a point geodataset to the point with the maximum rankfield
+    value in every grid cell, either square cells of cellsize or the cells
+    of a reference raster (see thin_grid). Output is a geopandas dataframe.
+
+    infile: (string) path, filename, and extension of input geodata file (e.g., shapefile)
+    rankfield: (string) fieldname of a numeric ranking field
+    cellsize: (number, float or integer) cell size, in projection units
+    reference: (string) path, filename, and extension of a raster in the
+        same projection, e.g. the climate grid; used instead of cellsize
+    tile_cells: (integer) width and height of the tiles, in cells
+    workers: (integer) number of worker processes
+    '''
+    if reference is not None:
+        geotransform = raster_grid(reference)
+    elif cellsize is not None:
+        geotransform = (0, cellsize, 0, 0, 0, cellsize)
+    else:
+        raise ValueError('Need a cellsize or a reference raster')
+    x, y, attrs, crs = read_points(infile)
+    keep = thin_grid(x, y, attrs[rankfield], geotransform, tile_cells, workers)
+    return kept_frame(x, y, attrs, crs, keep)
 
 if __name__ == "__main__":
     wd = r"D:\GIS\Projects\WYNDD\Final_inputs"
@@ -101,9 +513,9 @@ if __name__ == "__main__":
     outfile = os.path.join(wd, outfile)
     # Filter points
     kpdf = filter_by_distance_rank(infile, 1000, 'QRank')
-    pysal.pdio.write_files(kpdf, outfile)
+    write_frame(outfile, kpdf)
 
     # Remove duplicates
     #NAD83(2011) / Conus Albers = 'epsg:6350'
     outgdf = filter_duplicates(infile, 'OBJECTID', 'QRank', 'Pres_Abs', 'epsg:6350')
-    outgdf.to_file(outfile)
+    write_frame(outfile, outgdf)